@@ -1,7 +1,7 @@
 """FastAPI server for the code indexing agent."""
 from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
 from contextlib import asynccontextmanager
@@ -9,11 +9,13 @@ import os
 import logging
 from pathlib import Path
 
+import orjson
+
 from src.agent import Agent
 from src.models import FinalAnswer
 from src.indexing import CodeIndexer
 from src.search import CodeSearcher
-from src.tools import set_searcher
+from src.tools import cat_file_mmap, iter_mmap, set_searcher
 
 
 @asynccontextmanager
@@ -98,7 +100,8 @@ async def get_file(file_path: str):
     """Get file content."""
     from src.tools import cat_file
     
-    result = cat_file(file_path)
+    # The viewer shows the whole file, not the agent's default line range
+    result = cat_file(file_path, limit=None)
     
     if result["success"]:
         return {"content": result["content"]}
@@ -106,6 +109,20 @@ async def get_file(file_path: str):
         raise HTTPException(status_code=404, detail=result.get("error", "File not found"))
 
 
+@api_router.get("/file/raw")
+async def get_file_raw(file_path: str):
+    """Stream raw file content from a memory mapping, without building a string."""
+    mm = cat_file_mmap(file_path)
+    if mm is None:
+        # Empty or unmappable files go through the regular reader
+        from src.tools import cat_file
+        result = cat_file(file_path, limit=None)
+        if not result["success"]:
+            raise HTTPException(status_code=404, detail=result.get("error", "File not found"))
+        return PlainTextResponse(result["content"])
+    return StreamingResponse(iter_mmap(mm), media_type="text/plain; charset=utf-8")
+
+
 @api_router.get("/files")
 async def list_files():
     """List all indexed files."""
@@ -186,8 +203,12 @@ async def get_file_tree(root_path: str = "."):
 
 
 @api_router.post("/index", response_model=IndexResponse)
-async def index_codebase(request: IndexRequest):
-    """Index a codebase."""
+def index_codebase(request: IndexRequest):
+    """Index a codebase.
+    
+    Declared sync so FastAPI runs it in a worker thread: indexing is long
+    running and drives its own event loop for concurrent embedding calls.
+    """
     try:
         indexer = CodeIndexer()
         result = indexer.index(request.codebase_path, request.output_dir)
@@ -212,12 +233,10 @@ async def query(request: QueryRequest):
         )
         result: FinalAnswer = agent.query(request.question)
         
-        return QueryResponse(
-            answer=result.answer,
-            confidence=result.confidence,
-            sources=result.sources,
-            reasoning=result.reasoning
-        )
+        # FinalAnswer has exactly the QueryResponse fields and is already
+        # validated, so it is serialized directly instead of being copied
+        # into a QueryResponse and re-validated by FastAPI
+        return Response(content=orjson.dumps(result.model_dump()), media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Agent query failed: {str(e)}")
 
@@ -19,8 +19,11 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
 import json
 import os
+import random
+import re
 import sys
 from pathlib import Path
 
@@ -33,6 +36,75 @@ ENV_PATH = ROOT / ".env"
 # Koyeb API 基础 URL
 KOYEB_API_BASE = "https://app.koyeb.com/v1"
 
+# 瞬时错误重试策略：指数退避 1s, 2s, 4s...（上限 10s，另加随机抖动），最多尝试 5 次
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 10.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# 服务端 Retry-After 的等待上限（秒），避免异常大的值让部署脚本长时间挂起
+RETRY_AFTER_MAX_DELAY = 60.0
+
+# 创建 / 更新类请求（POST、PATCH 等）不是幂等的：读超时或 5xx 时服务端可能已经完成了操作，
+# 重试会触发冲突或重复创建。因此只在请求确定没有被处理时重试：连接未建立，或被限流 / 暂不可用
+NON_IDEMPOTENT_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+NON_IDEMPOTENT_RETRYABLE_STATUS_CODES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# Koyeb 服务名称中不允许出现的字符
+INVALID_SERVICE_NAME_CHARS = re.compile(r'[^a-z0-9-]')
+
+
+def create_client(api_key: str) -> httpx.AsyncClient:
+    """创建带认证头的 Koyeb API 异步客户端"""
+    return httpx.AsyncClient(
+        base_url=KOYEB_API_BASE,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        },
+        timeout=30.0,
+    )
+
+
+async def request(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    **kwargs,
+) -> httpx.Response:
+    """发送 API 请求，遇到瞬时错误时指数退避重试
+    
+    GET 等幂等请求遇到网络错误和 429/5xx 响应会重试；POST、PATCH 等非幂等请求只在
+    连接失败和 429/503 时重试，避免服务端已处理的创建请求被重复提交。
+    429/503 响应如果带 Retry-After 头则按其等待（最多 RETRY_AFTER_MAX_DELAY 秒）；其他 HTTP 错误直接抛出 httpx.HTTPStatusError。
+    """
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    retryable_errors = httpx.TransportError if idempotent else NON_IDEMPOTENT_RETRYABLE_ERRORS
+    retryable_status_codes = RETRYABLE_STATUS_CODES if idempotent else NON_IDEMPOTENT_RETRYABLE_STATUS_CODES
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            resp = await client.request(method, url, **kwargs)
+            resp.raise_for_status()
+            return resp
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if isinstance(e, httpx.HTTPStatusError):
+                status_code = e.response.status_code
+                retryable = status_code in retryable_status_codes
+            else:
+                status_code = None
+                retryable = isinstance(e, retryable_errors)
+            if attempt == MAX_ATTEMPTS or not retryable:
+                raise
+            
+            delay = min(RETRY_BASE_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY) + random.uniform(0, 1)
+            if status_code in (429, 503):
+                try:
+                    delay = min(max(float(e.response.headers.get("Retry-After", delay)), 0.0), RETRY_AFTER_MAX_DELAY)
+                except ValueError:
+                    pass
+            print(f"⚠ {method} {url} 失败 ({status_code or type(e).__name__})，{delay:.1f}s 后重试 ({attempt}/{MAX_ATTEMPTS - 1})")
+            await asyncio.sleep(delay)
+
 
 def load_env() -> dict[str, str]:
     """加载环境变量配置"""
@@ -43,13 +115,12 @@ def load_env() -> dict[str, str]:
 
 def normalize_service_name(service_name: str) -> str:
     """规范化服务名称：Koyeb 服务名称只能包含小写字母、数字和连字符，不能以下划线开头或结尾"""
-    import re
     # 将下划线替换为连字符，并转换为小写
     normalized = service_name.replace("_", "-").lower()
     # 移除开头和结尾的连字符
     normalized = normalized.strip("-")
     # 确保只包含小写字母、数字和连字符
-    normalized = re.sub(r'[^a-z0-9-]', '', normalized)
+    normalized = INVALID_SERVICE_NAME_CHARS.sub('', normalized)
     return normalized
 
 
@@ -70,59 +141,65 @@ def check_path_consistency(service_name: str) -> tuple[bool, str]:
     return True, ""
 
 
-def get_or_create_secret(
-    api_key: str,
+async def fetch_name_index(
+    client: httpx.AsyncClient,
+    resource: str,
+    params: dict | None = None,
+) -> dict[str, str]:
+    """列出 Koyeb 资源（apps / services / secrets），构建 name -> id 索引
+    
+    只请求一次列表，之后每次按名称查找都是 O(1) 的字典查询。
+    """
+    resp = await request(client, "GET", f"/{resource}", params=params)
+    return {
+        item.get("name"): item.get("id")
+        for item in resp.json().get(resource, [])
+    }
+
+
+async def get_or_create_secret(
+    client: httpx.AsyncClient,
     secret_name: str,
     secret_value: str | None = None,
+    secrets_index: dict[str, str] | None = None,
 ) -> str | None:
     """获取或创建 Koyeb Secret，返回 secret ID
     
     Args:
-        api_key: Koyeb API key
+        client: Koyeb API 客户端（见 create_client）
         secret_name: Secret 名称
         secret_value: Secret 值（如果提供，且 secret 不存在则创建）
+        secrets_index: 已获取的 Secret name -> id 索引（不提供则重新获取）
     
     Returns:
         Secret ID 或 None（如果失败）
     """
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    
     try:
         # 1. 检查 secret 是否已存在
-        secrets_resp = httpx.get(
-            f"{KOYEB_API_BASE}/secrets",
-            headers=headers,
-            timeout=30.0,
-        )
-        secrets_resp.raise_for_status()
-        secrets_data = secrets_resp.json()
+        if secrets_index is None:
+            secrets_index = await fetch_name_index(client, "secrets")
         
-        secret_id = None
-        for secret in secrets_data.get("secrets", []):
-            if secret.get("name") == secret_name:
-                secret_id = secret.get("id")
-                print(f"✓ Secret 已存在: {secret_name} ({secret_id})")
-                return secret_id
+        secret_id = secrets_index.get(secret_name)
+        if secret_id:
+            print(f"✓ Secret 已存在: {secret_name} ({secret_id})")
+            return secret_id
         
         # 2. Secret 不存在，如果提供了值则创建
         if secret_value:
             print(f"创建 Secret: {secret_name}...")
-            create_secret_resp = httpx.post(
-                f"{KOYEB_API_BASE}/secrets",
-                headers=headers,
+            create_secret_resp = await request(
+                client,
+                "POST",
+                "/secrets",
                 json={
                     "type": "SIMPLE",
                     "name": secret_name,
                     "value": secret_value,
                 },
-                timeout=30.0,
             )
-            create_secret_resp.raise_for_status()
             secret_data = create_secret_resp.json()
             secret_id = secret_data.get("secret", {}).get("id")
+            secrets_index[secret_name] = secret_id
             print(f"✓ Secret 创建成功: {secret_id}")
             return secret_id
         else:
@@ -142,7 +219,7 @@ def get_or_create_secret(
         return None
 
 
-def deploy(
+async def deploy(
     api_key: str,
     repo: str,
     app_name: str,
@@ -177,62 +254,36 @@ def deploy(
         print(f"  引用 Secrets: {', '.join(secret_refs)}")
     print()
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
+    client = create_client(api_key)
 
     # 用于保存最后一个请求的 payload，以便错误时显示
     last_request_payload = None
 
     try:
-        # 1. 检查或创建应用
+        # 1. 检查或创建应用；应用列表和 Secrets 校验互不依赖，并发请求
         print("检查应用是否存在...")
-        apps_resp = httpx.get(
-            f"{KOYEB_API_BASE}/apps",
-            headers=headers,
-            timeout=30.0,
+        apps_index, secrets_index = await asyncio.gather(
+            fetch_name_index(client, "apps"),
+            fetch_name_index(client, "secrets"),
         )
-        apps_resp.raise_for_status()
-        apps_data = apps_resp.json()
-
-        app_id = None
-        for app in apps_data.get("apps", []):
-            if app.get("name") == app_name:
-                app_id = app.get("id")
-                print(f"✓ 应用已存在: {app_id}")
-                break
 
-        if not app_id:
+        app_id = apps_index.get(app_name)
+        if app_id:
+            print(f"✓ 应用已存在: {app_id}")
+        else:
             print(f"创建应用: {app_name}...")
-            create_app_resp = httpx.post(
-                f"{KOYEB_API_BASE}/apps",
-                headers=headers,
-                json={"name": app_name},
-                timeout=30.0,
-            )
-            create_app_resp.raise_for_status()
+            create_app_resp = await request(client, "POST", "/apps", json={"name": app_name})
             app_data = create_app_resp.json()
             app_id = app_data.get("app", {}).get("id")
             print(f"✓ 应用创建成功: {app_id}")
 
         # 2. 检查或创建服务
         print(f"检查服务是否存在...")
-        services_resp = httpx.get(
-            f"{KOYEB_API_BASE}/services",
-            headers=headers,
-            params={"app_id": app_id},
-            timeout=30.0,
-        )
-        services_resp.raise_for_status()
-        services_data = services_resp.json()
+        services_index = await fetch_name_index(client, "services", params={"app_id": app_id})
 
-        service_id = None
-        for service in services_data.get("services", []):
-            if service.get("name") == service_name:
-                service_id = service.get("id")
-                print(f"✓ 服务已存在: {service_id}")
-                break
+        service_id = services_index.get(service_name)
+        if service_id:
+            print(f"✓ 服务已存在: {service_id}")
 
         # 构建 Git 仓库 URL（Koyeb API 需要 github.com/<org>/<repo> 格式）
         if repo.startswith("http://") or repo.startswith("https://"):
@@ -253,7 +304,9 @@ def deploy(
             # 验证 Secret 是否存在，然后使用插值语法引用
             missing_secrets = []
             for secret_name in secret_refs:
-                secret_id = get_or_create_secret(api_key, secret_name)
+                secret_id = await get_or_create_secret(
+                    client, secret_name, secrets_index=secrets_index
+                )
                 if secret_id:
                     # Koyeb API 使用插值语法 {{ secret.SECRET_NAME }} 引用 Secret
                     # 注意：格式必须是 {{ secret.SECRET_NAME }}，中间有空格
@@ -327,13 +380,13 @@ def deploy(
                 print(json.dumps(env_config, indent=2, ensure_ascii=False))
             # 保存请求 payload 以便错误时显示
             last_request_payload = service_payload
-            create_service_resp = httpx.post(
-                f"{KOYEB_API_BASE}/services",
-                headers=headers,
+            create_service_resp = await request(
+                client,
+                "POST",
+                "/services",
                 json=service_payload,
                 timeout=60.0,
             )
-            create_service_resp.raise_for_status()
             service_data = create_service_resp.json()
             service_id = service_data.get("service", {}).get("id")
             print(f"✓ 服务创建成功: {service_id}")
@@ -383,13 +436,13 @@ def deploy(
                         print(f"   {env_var['key']} = {value} (Secret 引用)")
                     else:
                         print(f"   {env_var['key']} = {value}")
-            update_service_resp = httpx.patch(
-                f"{KOYEB_API_BASE}/services/{service_id}",
-                headers=headers,
+            await request(
+                client,
+                "PATCH",
+                f"/services/{service_id}",
                 json=update_payload,
                 timeout=60.0,
             )
-            update_service_resp.raise_for_status()
             print(f"✓ 服务更新成功")
 
         print()
@@ -437,53 +490,47 @@ def deploy(
     except Exception as e:
         print(f"错误: {e}")
         return False
+    finally:
+        await client.aclose()
 
 
-def list_services(api_key: str, app_name: str | None = None) -> bool:
+async def list_services(api_key: str, app_name: str | None = None) -> bool:
     """列出 Koyeb 服务"""
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
+    client = create_client(api_key)
+    services_tasks: list[asyncio.Task] = []
     
     try:
         # 获取所有应用
-        apps_resp = httpx.get(
-            f"{KOYEB_API_BASE}/apps",
-            headers=headers,
-            timeout=30.0,
-        )
-        apps_resp.raise_for_status()
-        apps_data = apps_resp.json()
+        apps_resp = await request(client, "GET", "/apps")
+        apps = apps_resp.json().get("apps", [])
+        
+        # 如果指定了 app_name，只显示匹配的应用
+        matched_apps = [app for app in apps if not app_name or app.get("name") == app_name]
+        
+        # 拿到应用 ID 后立即并发发起每个应用的服务查询，输出时按顺序逐个等待，
+        # 这样第一个应用的结果一返回就能打印，不必等所有请求完成
+        services_tasks = [
+            asyncio.create_task(
+                request(client, "GET", "/services", params={"app_id": app.get("id")})
+            )
+            for app in matched_apps
+        ]
         
         print("=== Koyeb 应用和服务列表 ===\n")
         
-        apps = apps_data.get("apps", [])
         if not apps:
             print("未找到任何应用")
             return True
         
         print(f"找到 {len(apps)} 个应用:\n")
         
-        for app in apps:
+        for app, services_task in zip(matched_apps, services_tasks):
             app_id = app.get("id")
             app_name_current = app.get("name")
             
-            # 如果指定了 app_name，只显示匹配的应用
-            if app_name and app_name_current != app_name:
-                continue
-            
             print(f"应用: {app_name_current} (ID: {app_id})")
             
-            # 获取该应用下的所有服务
-            services_resp = httpx.get(
-                f"{KOYEB_API_BASE}/services",
-                headers=headers,
-                params={"app_id": app_id},
-                timeout=30.0,
-            )
-            services_resp.raise_for_status()
-            services_data = services_resp.json()
+            services_data = (await services_task).json()
             
             services = services_data.get("services", [])
             if services:
@@ -512,6 +559,11 @@ def list_services(api_key: str, app_name: str | None = None) -> bool:
         import traceback
         traceback.print_exc()
         return False
+    finally:
+        for task in services_tasks:
+            task.cancel()
+        await asyncio.gather(*services_tasks, return_exceptions=True)
+        await client.aclose()
 
 
 def main(argv: list[str] | None = None) -> int:
@@ -564,7 +616,7 @@ def main(argv: list[str] | None = None) -> int:
 
     # 如果只是列出服务，则执行并退出（不指定 app_name 以显示所有应用）
     if args.list:
-        success = list_services(api_key, None)  # 显示所有应用
+        success = asyncio.run(list_services(api_key, None))  # 显示所有应用
         return 0 if success else 1
 
     # 硬编码 app 名称为 ai-builders
@@ -603,7 +655,7 @@ def main(argv: list[str] | None = None) -> int:
         secret_refs.insert(0, "OPENAI_API_KEY")
 
     # 使用 REST API 部署
-    success = deploy(
+    success = asyncio.run(deploy(
         api_key=api_key,
         repo=args.repo,
         app_name=app_name,
@@ -611,7 +663,7 @@ def main(argv: list[str] | None = None) -> int:
         branch=args.branch,
         port=args.port,
         secret_refs=secret_refs,
-    )
+    ))
 
     return 0 if success else 1
 
@@ -18,7 +18,8 @@ def main():
     result = indexer.index(
         codebase_path=".",
         output_dir="self_index",
-        max_workers=32
+        max_workers=32,
+        max_concurrent_batches=5
     )
     
     print("=" * 60)
@@ -7,7 +7,7 @@ from openai import OpenAI
 from pydantic import ValidationError
 
 from src.models import FinalAnswer
-from src.tools import TOOLS
+from src.tools import OPENAI_TOOLS, TOOLS
 
 # Set up logging
 logging.basicConfig(
@@ -72,18 +72,8 @@ class Agent:
             return base_prompt + f"\n\n你最多有{self.max_iterations}轮机会来调用工具。"
     
     def _format_tools_for_openai(self) -> List[Dict[str, Any]]:
-        """Format tools for OpenAI API."""
-        return [
-            {
-                "type": "function",
-                "function": {
-                    "name": tool_name,
-                    "description": tool_info["description"],
-                    "parameters": tool_info["parameters"]
-                }
-            }
-            for tool_name, tool_info in TOOLS.items()
-        ]
+        """Format tools for OpenAI API (prebuilt once in src.tools)."""
+        return OPENAI_TOOLS
     
     def _execute_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
         """Execute a tool and return the result."""
@@ -1,15 +1,34 @@
 """Indexing service for codebase."""
+import ast
+import asyncio
+import hashlib
 import json
 import os
 import logging
+import queue
+import random
+import re
+import sqlite3
+import threading
+import warnings
+from dataclasses import dataclass
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-from openai import OpenAI
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
+from openai import AsyncOpenAI, OpenAI
 import faiss
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import time
 
+from src.search import METRIC_IP_NORMALIZED, faiss_threads, load_chunk_text
+
+try:
+    from tree_sitter_languages import get_language, get_parser
+except ImportError:  # Optional: without tree-sitter every file is parsed by the LLM
+    get_language = get_parser = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -17,6 +36,627 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Indices with at least this many vectors use an HNSW graph instead of exhaustive search
+HNSW_MIN_VECTORS = 10000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+
+# Scalar quantizers for stored vectors; None keeps full float32 vectors
+VECTOR_QUANTIZERS = {
+    "fp16": faiss.ScalarQuantizer.QT_fp16,  # 2x smaller, ranking practically unchanged
+    "8bit": faiss.ScalarQuantizer.QT_8bit,  # 4x smaller, fine for a coarse shortlist
+    "none": None,
+}
+
+# Output dimension of known embedding models; others are learned from the first response
+EMBEDDING_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+
+# Default maximum number of embedding API requests in flight at once
+EMBEDDING_CONCURRENCY = 16
+
+# Batches start after a random delay of up to this many seconds, so the first
+# wave of requests does not hit the API in one burst (and trip rate limits)
+EMBEDDING_START_JITTER = 0.05
+
+# Per-request embedding limits: the API caps inputs at 2048 and total tokens at
+# 300k; tokens are estimated at ~4 characters each, so keep a safety margin
+EMBEDDING_MAX_BATCH_ITEMS = 2048
+EMBEDDING_MAX_BATCH_TOKENS = 250_000
+
+# Embedding cache file, kept in the output directory across index runs
+EMBEDDING_CACHE_FILE = "emb_cache.sqlite"
+
+# Per-file (size, mtime, sha256) manifest used to skip unchanged files on re-index
+MANIFEST_FILE = "manifest.json"
+
+# Chunks whose 64-bit SimHashes differ in at most this many bits share one embedding
+SIMHASH_MAX_DISTANCE = 3
+SIMHASH_SHINGLE_SIZE = 5
+
+# Files larger than this (in bytes) are never read whole: they get a file chunk
+# embedded from a head+tail sample, and no function parsing
+LARGE_FILE_BYTES = 50000
+LARGE_FILE_SAMPLE_BYTES = 8192
+STREAM_READ_SIZE = 1 << 20
+
+# Directories never descended into when scanning for source files
+IGNORED_DIRS = {'.venv', 'node_modules', '__pycache__', '.git', 'tests'}
+
+# Regex fast path for languages whose function headers are easy to spot
+GO_FUNC_PATTERN = re.compile(r'^func(?:\s+\([^)]*\))?\s+([A-Za-z_]\w*)', re.M)
+
+
+# tree-sitter grammar and function query per file extension
+TREE_SITTER_LANGUAGES = {
+    '.py': ('python', """
+        (function_definition name: (identifier) @name) @function
+    """),
+    '.js': ('javascript', """
+        (function_declaration name: (identifier) @name) @function
+        (method_definition name: (property_identifier) @name) @function
+    """),
+    '.ts': ('typescript', """
+        (function_declaration name: (identifier) @name) @function
+        (method_definition name: (property_identifier) @name) @function
+    """),
+    '.go': ('go', """
+        (function_declaration name: (identifier) @name) @function
+        (method_declaration name: (field_identifier) @name) @function
+    """),
+    '.java': ('java', """
+        (method_declaration name: (identifier) @name) @function
+        (constructor_declaration name: (identifier) @name) @function
+    """),
+    '.c': ('c', """
+        (function_definition declarator: (function_declarator declarator: (identifier) @name)) @function
+    """),
+    '.cpp': ('cpp', """
+        (function_definition declarator: (function_declarator declarator: (identifier) @name)) @function
+        (function_definition declarator: (function_declarator declarator: (field_identifier) @name)) @function
+        (function_definition declarator: (function_declarator declarator: (qualified_identifier) @name)) @function
+    """),
+    '.rs': ('rust', """
+        (function_item name: (identifier) @name) @function
+    """),
+    '.rb': ('ruby', """
+        (method name: (identifier) @name) @function
+        (singleton_method name: (identifier) @name) @function
+    """),
+    '.php': ('php', """
+        (function_definition name: (name) @name) @function
+        (method_declaration name: (name) @name) @function
+    """),
+}
+
+# Parser and compiled query per extension, built on first use in each thread
+# (a tree-sitter Parser must not be shared between threads)
+_tree_sitter_local = threading.local()
+
+
+def _get_tree_sitter_parser(extension: str) -> Optional[tuple]:
+    """Return (parser, query) for an extension, or None if unsupported."""
+    if get_parser is None or extension not in TREE_SITTER_LANGUAGES:
+        return None
+    parsers = getattr(_tree_sitter_local, "parsers", None)
+    if parsers is None:
+        parsers = _tree_sitter_local.parsers = {}
+    if extension not in parsers:
+        language_name, query_source = TREE_SITTER_LANGUAGES[extension]
+        parsers[extension] = (
+            get_parser(language_name),
+            get_language(language_name).query(query_source),
+        )
+    return parsers[extension]
+
+
+def _parse_functions_with_tree_sitter(file_path: str, content: str) -> Optional[List[Dict[str, Any]]]:
+    """Extract functions from the syntax tree, or None if the language is unsupported."""
+    parser_and_query = _get_tree_sitter_parser(Path(file_path).suffix)
+    if parser_and_query is None:
+        return None
+    parser, query = parser_and_query
+    
+    tree = parser.parse(content.encode('utf-8'))
+    functions = []
+    current = None
+    # Captures come in source order; a @name always follows its @function
+    for node, capture_name in query.captures(tree.root_node):
+        if capture_name == "function":
+            current = node
+        elif current is not None:
+            functions.append({
+                "function_name": node.text.decode('utf-8', errors='replace'),
+                "start_line": current.start_point[0] + 1,
+                "end_line": current.end_point[0] + 1
+            })
+            current = None
+    return functions
+
+
+# Chunk type codes stored in ChunkTable.types
+CHUNK_TYPES = ("file", "function")
+CHUNK_FILE, CHUNK_FUNCTION = range(len(CHUNK_TYPES))
+
+
+@dataclass
+class ChunkTable:
+    """Chunks as parallel columns (struct of arrays) rather than a list of dicts.
+    
+    Row i is one chunk. Per-chunk dicts are only materialized by to_dicts()
+    when metadata is written.
+    """
+    types: np.ndarray  # uint8 codes into CHUNK_TYPES
+    file_paths: List[str]
+    function_names: List[Optional[str]]
+    start_lines: np.ndarray  # int32
+    end_lines: np.ndarray  # int32
+    content_hashes: List[str]
+    sampled: np.ndarray  # bool; file chunk embedded from a head+tail sample
+    dup_of: np.ndarray  # int32; table row of the chunk whose embedding this one reuses, or -1
+    
+    @classmethod
+    def from_columns(
+        cls,
+        types: List[int],
+        file_paths: List[str],
+        function_names: List[Optional[str]],
+        start_lines: List[int],
+        end_lines: List[int],
+        content_hashes: List[str],
+        sampled: Optional[List[bool]] = None
+    ) -> "ChunkTable":
+        """Build a table from per-column Python lists."""
+        return cls(
+            types=np.array(types, dtype=np.uint8),
+            file_paths=file_paths,
+            function_names=function_names,
+            start_lines=np.array(start_lines, dtype=np.int32),
+            end_lines=np.array(end_lines, dtype=np.int32),
+            content_hashes=content_hashes,
+            sampled=np.array(sampled if sampled is not None else [False] * len(types), dtype=bool),
+            dup_of=np.full(len(types), -1, dtype=np.int32)
+        )
+    
+    @classmethod
+    def from_dicts(cls, chunks: List[Dict[str, Any]]) -> "ChunkTable":
+        """Build a table from metadata.json chunk dicts (dup_of is not carried over)."""
+        return cls.from_columns(
+            [CHUNK_TYPES.index(c["type"]) for c in chunks],
+            [c["file_path"] for c in chunks],
+            [c.get("function_name") for c in chunks],
+            [c["start_line"] for c in chunks],
+            [c["end_line"] for c in chunks],
+            [c["content_hash"] for c in chunks],
+            sampled=[c.get("sampled", False) for c in chunks]
+        )
+    
+    @classmethod
+    def empty(cls) -> "ChunkTable":
+        return cls.from_columns([], [], [], [], [], [])
+    
+    @classmethod
+    def concat(cls, tables: List["ChunkTable"]) -> "ChunkTable":
+        """Concatenate tables row-wise, in order."""
+        if not tables:
+            return cls.empty()
+        return cls(
+            types=np.concatenate([t.types for t in tables]),
+            file_paths=[p for t in tables for p in t.file_paths],
+            function_names=[n for t in tables for n in t.function_names],
+            start_lines=np.concatenate([t.start_lines for t in tables]),
+            end_lines=np.concatenate([t.end_lines for t in tables]),
+            content_hashes=[h for t in tables for h in t.content_hashes],
+            sampled=np.concatenate([t.sampled for t in tables]),
+            dup_of=np.concatenate([t.dup_of for t in tables])
+        )
+    
+    def __len__(self) -> int:
+        return len(self.types)
+    
+    def rows_of(self, chunk_type: int) -> np.ndarray:
+        """Row numbers of all chunks of one type, in table order."""
+        return np.flatnonzero(self.types == chunk_type)
+    
+    def positions_in_type(self) -> np.ndarray:
+        """Position of every row among the rows of its type, i.e. its FAISS vector id."""
+        positions = np.empty(len(self), dtype=np.int64)
+        for type_code in range(len(CHUNK_TYPES)):
+            rows = self.rows_of(type_code)
+            positions[rows] = np.arange(len(rows))
+        return positions
+    
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        """Materialize the metadata.json chunk dicts.
+        
+        dup_of is written as the representative's position among chunks of
+        the same type.
+        """
+        positions = self.positions_in_type()
+        chunks = []
+        for i, (type_code, start_line, end_line, sampled, dup_of) in enumerate(zip(
+            self.types.tolist(),
+            self.start_lines.tolist(),
+            self.end_lines.tolist(),
+            self.sampled.tolist(),
+            self.dup_of.tolist()
+        )):
+            chunk = {"type": CHUNK_TYPES[type_code], "file_path": self.file_paths[i]}
+            if type_code == CHUNK_FUNCTION:
+                chunk["function_name"] = self.function_names[i]
+            chunk["content_hash"] = self.content_hashes[i]
+            chunk["start_line"] = start_line
+            chunk["end_line"] = end_line
+            if sampled:
+                chunk["sampled"] = True
+            if dup_of >= 0:
+                chunk["dup_of"] = int(positions[dup_of])
+            chunks.append(chunk)
+        return chunks
+
+
+def _create_chunks(file_path: str, content: str, functions: List[Dict[str, Any]]) -> ChunkTable:
+    """Create the file chunk and one chunk per function.
+    
+    Chunks hold only the line span and a hash of the text, not the text
+    itself; see CodeIndexer._load_chunk_text.
+    """
+    # Function spans are byte slices between newline offsets; no per-line strings
+    data = content.encode('utf-8')
+    newlines = _newline_offsets(data)
+    
+    # File chunk first, then function chunks
+    types = [CHUNK_FILE]
+    function_names = [None]
+    start_lines = [1]
+    end_lines = [len(newlines) + 1]
+    content_hashes = [_content_hash(data)]
+    
+    for func in functions:
+        begin, end = _line_span(newlines, len(data), func["start_line"], func["end_line"])
+        types.append(CHUNK_FUNCTION)
+        function_names.append(func["function_name"])
+        start_lines.append(func["start_line"])
+        end_lines.append(func["end_line"])
+        content_hashes.append(_content_hash(data[begin:end]))
+    
+    return ChunkTable.from_columns(
+        types, [file_path] * len(types), function_names, start_lines, end_lines, content_hashes
+    )
+
+
+def _read_and_parse(
+    file_path: str,
+    file_index: int,
+    total_files: int
+) -> Tuple[Optional[ChunkTable], Optional[str]]:
+    """Read a file and chunk it, extracting functions with tree-sitter.
+    
+    Runs in a worker process, so it must stay a picklable module-level
+    function. Returns (chunks, content); chunks is None when the file's
+    language needs the LLM parser, and content is None for files that were
+    not read whole (too large, binary or unreadable).
+    """
+    # One timer and one summary record per file; %-style arguments are only
+    # formatted when the record is actually emitted
+    start_time = time.perf_counter()
+    
+    try:
+        size = os.stat(file_path).st_size
+        if size > LARGE_FILE_BYTES:
+            # Skip very large files to avoid timeout, without materializing them
+            logger.warning("   ⚠️  Skipping function parsing for large file %s (%d bytes)", file_path, size)
+            content_hash, newlines = _scan_large_file(file_path)
+            chunks = ChunkTable.from_columns(
+                [CHUNK_FILE], [file_path], [None], [1], [newlines + 1], [content_hash], sampled=[True]
+            )
+            logger.info("📄 (%d/%d) %s: file chunk only (%.2fs)",
+                        file_index + 1, total_files, file_path, time.perf_counter() - start_time)
+            return chunks, None
+        
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            content = f.read()
+    except Exception as e:
+        logger.warning("   ✗ Failed to read %s: %s", file_path, e)
+        if logger.isEnabledFor(logging.DEBUG):
+            import traceback
+            logger.debug(traceback.format_exc())
+        return ChunkTable.empty(), None
+    
+    if '\x00' in content:
+        logger.warning("   ⚠️  Skipping binary file %s", file_path)
+        return ChunkTable.empty(), None
+    
+    functions = _parse_functions_fast(file_path, content)
+    if not functions:
+        # No fast path for this language, or it found nothing: ask tree-sitter
+        try:
+            tree_sitter_functions = _parse_functions_with_tree_sitter(file_path, content)
+        except Exception as e:
+            logger.warning("   [PARSE] tree-sitter failed for %s, falling back to LLM: %s", file_path, e)
+            tree_sitter_functions = None
+        if tree_sitter_functions is not None or functions is None:
+            functions = tree_sitter_functions
+    if functions is None:
+        return None, content
+    
+    chunks = _create_chunks(file_path, content, functions)
+    logger.info("📄 (%d/%d) %s: %d functions, %d chunks (%.2fs)",
+                file_index + 1, total_files, file_path, len(functions), len(chunks),
+                time.perf_counter() - start_time)
+    return chunks, content
+
+
+def _scan_large_file(file_path: str) -> Tuple[str, int]:
+    """Stream a file in binary blocks, returning its SHA-256 and newline count."""
+    digest = hashlib.sha256()
+    newlines = 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_READ_SIZE), b""):
+            digest.update(block)
+            newlines += block.count(b"\n")
+    return digest.hexdigest(), newlines
+
+
+def _read_file_sample(file_path: str) -> str:
+    """Head and tail of a large file, used as its file chunk's embedding text."""
+    with open(file_path, 'rb') as f:
+        head = f.read(LARGE_FILE_SAMPLE_BYTES)
+        f.seek(0, os.SEEK_END)
+        f.seek(max(len(head), f.tell() - LARGE_FILE_SAMPLE_BYTES))
+        tail = f.read()
+    sample = head.decode('utf-8', errors='replace')
+    if tail:
+        sample += "\n...\n" + tail.decode('utf-8', errors='replace')
+    return sample
+
+
+def _parse_python_functions(content: str) -> Optional[List[Dict[str, Any]]]:
+    """Extract functions with the stdlib parser, or None if the source does not parse.
+    
+    Line numbers come from the AST (the def line through end_lineno), so
+    strings and comments inside a body cannot end a function early.
+    """
+    try:
+        with warnings.catch_warnings():
+            # Invalid escape sequences etc. in the indexed code are not our concern
+            warnings.simplefilter("ignore")
+            tree = ast.parse(content)
+    except (SyntaxError, ValueError, RecursionError):
+        return None
+    nodes = [
+        node for node in ast.walk(tree)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+    ]
+    nodes.sort(key=lambda node: node.lineno)
+    return [
+        {
+            "function_name": node.name,
+            "start_line": node.lineno,
+            "end_line": node.end_lineno
+        }
+        for node in nodes
+    ]
+
+
+def _go_function_end(lines: List[str], start: int) -> int:
+    """1-based last line of the func on 0-based line start (gofmt puts its closing brace in column 0)."""
+    if lines[start].rstrip().endswith('}'):
+        return start + 1
+    for i in range(start + 1, len(lines)):
+        if lines[i].startswith('}'):
+            return i + 1
+    return len(lines)
+
+
+# Function header pattern and end-line finder per extension
+REGEX_FAST_PATHS = {
+    '.go': (GO_FUNC_PATTERN, _go_function_end),
+}
+
+
+def _parse_functions_fast(file_path: str, content: str) -> Optional[List[Dict[str, Any]]]:
+    """Extract functions without tree-sitter or the LLM, or None if there is no fast path.
+    
+    Python goes through the stdlib ast module, Go through a compiled regex.
+    """
+    suffix = Path(file_path).suffix
+    if suffix == '.py':
+        return _parse_python_functions(content)
+    fast_path = REGEX_FAST_PATHS.get(suffix)
+    if fast_path is None:
+        return None
+    pattern, find_end = fast_path
+    
+    matches = list(pattern.finditer(content))
+    if not matches:
+        return []
+    lines = content.split('\n')
+    # Map match offsets to 0-based line numbers in one vectorized search
+    line_starts = np.cumsum([0] + [len(line) + 1 for line in lines[:-1]])
+    start_rows = np.searchsorted(line_starts, [m.start() for m in matches], side='right') - 1
+    return [
+        {
+            "function_name": match.group(1),
+            "start_line": row + 1,
+            "end_line": find_end(lines, row)
+        }
+        for match, row in zip(matches, start_rows.tolist())
+    ]
+
+
+def _file_sha256(file_path: str, size: int) -> str:
+    """Hash a file the same way _read_and_parse hashed it for its file chunk."""
+    if size > LARGE_FILE_BYTES:
+        return _scan_large_file(file_path)[0]
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        return _content_hash(f.read().encode('utf-8'))
+
+
+def _pack_batches(
+    texts: List[str],
+    max_tokens: int = EMBEDDING_MAX_BATCH_TOKENS,
+    max_items: int = EMBEDDING_MAX_BATCH_ITEMS
+) -> Iterator[Tuple[int, int]]:
+    """Yield [start, end) ranges of consecutive texts that fit in one embedding request."""
+    start = 0
+    tokens = 0
+    for i, text in enumerate(texts):
+        text_tokens = max(1, len(text) // 4)
+        if i > start and (tokens + text_tokens > max_tokens or i - start >= max_items):
+            yield start, i
+            start, tokens = i, 0
+        tokens += text_tokens
+    if start < len(texts):
+        yield start, len(texts)
+
+
+def _merge_vectors(reused: Optional[np.ndarray], new: np.ndarray) -> np.ndarray:
+    """Reused vectors followed by new embeddings, in one float32 matrix."""
+    if reused is None or len(reused) == 0:
+        return new
+    if len(new) == 0:
+        return reused
+    merged = np.empty((len(reused) + len(new), reused.shape[1]), dtype=np.float32)
+    merged[:len(reused)] = reused
+    merged[len(reused):] = new
+    return merged
+
+
+def _content_hash(data: bytes) -> str:
+    """SHA-256 of a chunk's UTF-8 text, stored in metadata in place of the text."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def _newline_offsets(data: bytes) -> np.ndarray:
+    """Byte offsets of every newline in data, found in one vectorized scan."""
+    return np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+
+
+def _line_span(newlines: np.ndarray, size: int, start_line: int, end_line: int) -> Tuple[int, int]:
+    """Byte range [begin, end) of the 1-based inclusive lines start_line..end_line.
+    
+    Matches slicing the split lines: out-of-range lines are clamped, and
+    each range ends before its trailing newline. A newline byte never
+    occurs inside a multi-byte UTF-8 sequence, so the range always decodes.
+    """
+    num_lines = len(newlines) + 1
+    start_line = max(start_line, 1)
+    end_line = min(end_line, num_lines)
+    if start_line > end_line:
+        return 0, 0
+    begin = 0 if start_line == 1 else int(newlines[start_line - 2]) + 1
+    end = size if end_line == num_lines else int(newlines[end_line - 1])
+    return begin, end
+
+
+def _simhash(text: str) -> int:
+    """64-bit SimHash of a text over shingles of consecutive whitespace tokens."""
+    tokens = text.split()
+    shingles = [
+        ' '.join(tokens[i:i + SIMHASH_SHINGLE_SIZE])
+        for i in range(max(1, len(tokens) - SIMHASH_SHINGLE_SIZE + 1))
+    ]
+    digests = b''.join(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest() for s in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1)
+    # Each output bit is set when the majority of shingle hashes have it set
+    majority = bits.sum(axis=0, dtype=np.int64) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(majority).tobytes(), 'big')
+
+
+def _group_near_duplicates(texts: List[str]) -> List[int]:
+    """Map each text to the index of its representative near-duplicate.
+    
+    A text is its own representative unless an earlier text's SimHash is
+    within SIMHASH_MAX_DISTANCE bits. Candidates are bucketed by the top 16
+    bits of the hash, which keeps grouping linear in the number of texts.
+    """
+    representatives = []
+    buckets: Dict[int, List[tuple]] = {}
+    for i, text in enumerate(texts):
+        fingerprint = _simhash(text)
+        bucket = buckets.setdefault(fingerprint >> 48, [])
+        for rep_fingerprint, rep_index in bucket:
+            if (fingerprint ^ rep_fingerprint).bit_count() <= SIMHASH_MAX_DISTANCE:
+                representatives.append(rep_index)
+                break
+        else:
+            bucket.append((fingerprint, i))
+            representatives.append(i)
+    return representatives
+
+
+class _StreamingIndexWriter:
+    """Fills a FAISS index on a background thread while embeddings are still arriving.
+    
+    FAISS ids are insertion order, so rows are added strictly in order: a
+    batch that completes early waits until every row before it is filled.
+    Rows may come from several matrices; put() says where each one starts.
+    """
+    
+    def __init__(self, make_index: Callable[[int], faiss.Index], num_rows: int):
+        self.num_rows = num_rows
+        self._make_index = make_index
+        self._index: Optional[faiss.Index] = None
+        self._error: Optional[Exception] = None
+        self._filled = np.zeros(num_rows, dtype=bool)
+        self._added = 0
+        # (offset, matrix): matrix row r is index row offset + r
+        self._sources: List[Tuple[int, np.ndarray]] = []
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+        self._thread.start()
+    
+    def put(self, offset: int, matrix: np.ndarray, rows: np.ndarray):
+        """Hand over rows of matrix (local row numbers) that now hold their final vectors."""
+        self._queue.put((offset, matrix, rows))
+    
+    def close(self) -> Optional[faiss.Index]:
+        """Wait for queued rows, returning the index if it holds every row, else None."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            logger.warning(f"   Streaming index build failed, building after embedding: {self._error}")
+            return None
+        if self._index is None or self._index.ntotal != self.num_rows:
+            return None
+        return self._index
+    
+    def _consume(self):
+        with faiss_threads(os.cpu_count() or 1):
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                if self._error is not None:
+                    continue
+                try:
+                    self._add_filled(*item)
+                except Exception as e:
+                    self._error = e
+    
+    def _add_filled(self, offset: int, matrix: np.ndarray, rows: np.ndarray):
+        if not any(source is matrix for _, source in self._sources):
+            self._sources.append((offset, matrix))
+        self._filled[offset + rows] = True
+        # Advance over the filled prefix, one source matrix at a time
+        unfilled = np.flatnonzero(~self._filled[self._added:])
+        end = self._added + unfilled[0] if len(unfilled) else self.num_rows
+        while self._added < end:
+            source_offset, source = next(
+                (o, m) for o, m in self._sources if o <= self._added < o + len(m)
+            )
+            stop = min(end, source_offset + len(source))
+            block = source[self._added - source_offset:stop - source_offset]
+            faiss.normalize_L2(block)
+            if self._index is None:
+                self._index = self._make_index(block.shape[1])
+            self._index.add(block)
+            self._added = stop
+
 
 class CodeIndexer:
     """Index codebase with file and function level chunks."""
@@ -25,31 +665,54 @@ class CodeIndexer:
         self,
         embedding_model: str = "text-embedding-3-small",
         parse_model: str = "gpt-5-mini",
-        api_key: Optional[str] = None
+        api_key: Optional[str] = None,
+        vector_quantization: str = "fp16"
     ):
+        if vector_quantization not in VECTOR_QUANTIZERS:
+            raise ValueError(f"vector_quantization must be one of {sorted(VECTOR_QUANTIZERS)}, got {vector_quantization!r}")
         self.embedding_model = embedding_model
         self.parse_model = parse_model
-        self.client = OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"))
+        self.vector_quantization = vector_quantization
+        self._emb_dim: Optional[int] = EMBEDDING_DIMENSIONS.get(embedding_model)
+        self._api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.client = OpenAI(api_key=self._api_key)
         self.supported_extensions = {'.py', '.js', '.ts', '.go', '.java', '.cpp', '.c', '.rs', '.rb', '.php'}
+        # Content-hash keyed embedding cache, opened lazily by index()
+        self._emb_cache_path: Optional[Path] = None
+        self._emb_cache: Optional[sqlite3.Connection] = None
+        self._emb_cache_lock = threading.Lock()
+        # One canonical copy of each file's text, kept by index() until embedding is done
+        self._file_text: Dict[str, str] = {}
+        self._file_bytes = lru_cache(maxsize=32)(self._encode_file_text)
         
     def _get_supported_files(self, codebase_path: str) -> List[str]:
-        """Get all supported source files from codebase."""
+        """Get all supported source files from codebase.
+        
+        Walks the tree once with os.scandir, classifying files by suffix and
+        never descending into ignored directories.
+        """
         files = []
-        path = Path(codebase_path)
+        suffixes = tuple(self.supported_extensions)
+        stack = [codebase_path]
         
-        for ext in self.supported_extensions:
-            for file_path in path.rglob(f"*{ext}"):
-                # Skip virtual environments, test directories, and common ignore patterns
-                if any(ignore in str(file_path) for ignore in ['.venv', 'node_modules', '__pycache__', '.git', 'tests/']):
-                    continue
-                files.append(str(file_path))
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            # Skip virtual environments, test directories, and common ignore patterns
+                            if entry.name not in IGNORED_DIRS:
+                                stack.append(entry.path)
+                        elif entry.name.endswith(suffixes) and entry.is_file():
+                            files.append(str(Path(entry.path)))
+            except OSError as e:
+                logger.warning(f"   ✗ Failed to scan directory: {e}")
         
         return sorted(files)
     
-    def _parse_functions(self, file_path: str, content: str) -> List[Dict[str, Any]]:
+    def _parse_functions_with_llm(self, file_path: str, content: str) -> List[Dict[str, Any]]:
         """Parse functions from a file using LLM."""
-        logger.debug(f"   [PARSE] Starting function parsing for {file_path}")
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         prompt = f"""分析以下代码文件，识别出所有函数（包括类方法）。
 
@@ -68,8 +731,6 @@ class CodeIndexer:
 只返回 JSON 对象，不要其他文字。如果文件没有函数，返回 {{"functions": []}}。"""
 
         try:
-            logger.debug(f"   [PARSE] Sending API request for {file_path}")
-            api_start = time.time()
             response = self.client.chat.completions.create(
                 model=self.parse_model,
                 messages=[
@@ -105,137 +766,490 @@ class CodeIndexer:
                     }
                 }
             )
-            api_time = time.time() - api_start
-            logger.debug(f"   [PARSE] API response received for {file_path} (took {api_time:.2f}s)")
-            
-            logger.debug(f"   [PARSE] Parsing JSON response for {file_path}")
             result = json.loads(response.choices[0].message.content)
             functions = result.get("functions", [])
             functions = functions if isinstance(functions, list) else []
             
-            total_time = time.time() - start_time
-            logger.debug(f"   [PARSE] Completed parsing for {file_path}: {len(functions)} functions (total: {total_time:.2f}s)")
+            logger.debug("   [PARSE] LLM parsed %s: %d functions (took %.2fs)",
+                         file_path, len(functions), time.perf_counter() - start_time)
             return functions
         except Exception as e:
-            total_time = time.time() - start_time
-            logger.warning(f"   [PARSE] Failed to parse functions in {file_path} (took {total_time:.2f}s): {e}")
-            import traceback
-            logger.debug(traceback.format_exc())
+            logger.warning("   [PARSE] Failed to parse functions in %s (took %.2fs): %s",
+                           file_path, time.perf_counter() - start_time, e)
+            if logger.isEnabledFor(logging.DEBUG):
+                import traceback
+                logger.debug(traceback.format_exc())
             return []
     
-    def _create_chunks(self, file_path: str, content: str, functions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Create file and function chunks."""
-        chunks = []
-        lines = content.split('\n')
-        
-        # File chunk
-        chunks.append({
-            "type": "file",
-            "file_path": file_path,
-            "content": content,
-            "start_line": 1,
-            "end_line": len(lines)
-        })
-        
-        # Function chunks
-        for func in functions:
-            start = func["start_line"] - 1  # Convert to 0-based
-            end = func["end_line"]
-            func_content = '\n'.join(lines[start:end])
-            
-            chunks.append({
-                "type": "function",
-                "file_path": file_path,
-                "function_name": func["function_name"],
-                "content": func_content,
-                "start_line": func["start_line"],
-                "end_line": func["end_line"]
-            })
+    def _encode_file_text(self, file_path: str) -> Tuple[bytes, np.ndarray]:
+        """UTF-8 bytes of a file's canonical text and their newline offsets (cached by _file_bytes)."""
+        data = self._file_text[file_path].encode('utf-8')
+        return data, _newline_offsets(data)
+    
+    def _load_chunk_text(self, chunks: ChunkTable, row: int) -> str:
+        """Materialize a chunk's text for embedding.
         
-        return chunks
+        Slices the canonical text read during parsing, and only goes back to
+        disk for files that were not kept. Large files are embedded from a
+        head+tail sample instead of in full.
+        """
+        file_path = chunks.file_paths[row]
+        if chunks.sampled[row]:
+            return _read_file_sample(file_path)
+        start_line, end_line = int(chunks.start_lines[row]), int(chunks.end_lines[row])
+        content = self._file_text.get(file_path)
+        if content is None:
+            return load_chunk_text(file_path, start_line, end_line)
+        if chunks.types[row] == CHUNK_FILE:
+            return content
+        data, newlines = self._file_bytes(file_path)
+        begin, end = _line_span(newlines, len(data), start_line, end_line)
+        return data[begin:end].decode('utf-8')
+    
+    def _open_embedding_cache(self) -> Optional[sqlite3.Connection]:
+        """Open (and create if needed) the on-disk embedding cache."""
+        if self._emb_cache is None and self._emb_cache_path is not None:
+            self._emb_cache = sqlite3.connect(str(self._emb_cache_path), check_same_thread=False)
+            self._emb_cache.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, dim INTEGER, vec BLOB)"
+            )
+        return self._emb_cache
+    
+    def _close_embedding_cache(self):
+        """Close the embedding cache connection, if open."""
+        if self._emb_cache is not None:
+            self._emb_cache.close()
+            self._emb_cache = None
+    
+    def _embedding_cache_key(self, text: str) -> bytes:
+        """Cache key for a text: SHA-256 of the embedding model and the content."""
+        return hashlib.sha256((self.embedding_model + "\0" + text).encode('utf-8')).digest()
     
-    def _get_embeddings(self, texts: List[str]) -> np.ndarray:
-        """Get embeddings for a list of texts."""
-        logger.debug(f"   [EMBED] Getting embeddings for {len(texts)} texts")
-        start_time = time.time()
+    async def _get_embeddings_async(self, client: AsyncOpenAI, texts: List[str]) -> np.ndarray:
+        """Get embeddings for a list of texts.
         
-        response = self.client.embeddings.create(
-            model=self.embedding_model,
-            input=texts
-        )
+        Texts already embedded by a previous run are read from the on-disk
+        cache; only cache misses are sent to the embedding API, and identical
+        texts are sent once and share the result.
+        """
+        start_time = time.perf_counter()
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        
+        keys = [self._embedding_cache_key(text) for text in texts]
+        unique_keys = list(dict.fromkeys(keys))
+        cached: Dict[bytes, np.ndarray] = {}
+        with self._emb_cache_lock:
+            cache = self._open_embedding_cache()
+            if cache is not None:
+                # Stay well below SQLite's bound-parameter limit
+                for i in range(0, len(unique_keys), 500):
+                    key_batch = unique_keys[i:i+500]
+                    rows = cache.execute(
+                        f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(key_batch))})",
+                        key_batch
+                    )
+                    for key, vec in rows:
+                        cached[key] = np.frombuffer(vec, dtype=np.float32)
+        
+        # First position of each distinct text that is not cached yet
+        first_miss: Dict[bytes, int] = {}
+        for i, key in enumerate(keys):
+            if key not in cached and key not in first_miss:
+                first_miss[key] = i
+        misses = list(first_miss.values())
+        if misses:
+            response = await client.embeddings.create(
+                model=self.embedding_model,
+                input=[texts[i] for i in misses]
+            )
+            new_rows = []
+            for i, item in zip(misses, response.data):
+                vec = np.asarray(item.embedding, dtype=np.float32)
+                if self._emb_dim is not None and len(vec) != self._emb_dim:
+                    raise ValueError(
+                        f"{self.embedding_model} returned {len(vec)}-dimensional embeddings, expected {self._emb_dim}"
+                    )
+                cached[keys[i]] = vec
+                new_rows.append((keys[i], len(vec), vec.tobytes()))
+            with self._emb_cache_lock:
+                cache = self._open_embedding_cache()
+                if cache is not None:
+                    with cache:
+                        cache.executemany(
+                            "INSERT OR REPLACE INTO embeddings (key, dim, vec) VALUES (?, ?, ?)",
+                            new_rows
+                        )
         
-        embeddings = [item.embedding for item in response.data]
-        elapsed = time.time() - start_time
-        logger.debug(f"   [EMBED] Got embeddings (took {elapsed:.2f}s)")
-        return np.array(embeddings, dtype=np.float32)
+        embeddings = np.empty((len(texts), self._emb_dim or len(cached[keys[0]])), dtype=np.float32)
+        for i, key in enumerate(keys):
+            embeddings[i] = cached[key]
+        
+        logger.debug("   [EMBED] Got %d embeddings (%d sent to the API, took %.2fs)",
+                     len(texts), len(misses), time.perf_counter() - start_time)
+        return embeddings
     
-    def _process_single_file(self, file_path: str, file_index: int, total_files: int) -> List[Dict[str, Any]]:
-        """Process a single file and return its chunks."""
-        logger.info(f"📄 Processing ({file_index+1}/{total_files}): {file_path}")
-        start_time = time.time()
+    async def _embed_contents(
+        self,
+        client: AsyncOpenAI,
+        semaphore: asyncio.Semaphore,
+        contents: List[str],
+        label: str,
+        num_rows: int,
+        target_rows: Optional[List[List[int]]] = None,
+        writer: Optional[_StreamingIndexWriter] = None
+    ) -> np.ndarray:
+        """Embed texts in batches packed up to the API's token and item limits.
         
-        try:
-            logger.debug(f"   [READ] Reading file {file_path}")
-            read_start = time.time()
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            read_time = time.time() - read_start
-            logger.debug(f"   [READ] Read file {file_path} ({len(content)} chars, took {read_time:.2f}s)")
+        Batches are sent concurrently, bounded by the shared semaphore. Each
+        batch is written straight into one preallocated (num_rows, dim) matrix
+        as it completes: row i holds contents[i], or, when target_rows is
+        given, every row in target_rows[i] receives the embedding of contents[i].
+        Filled rows are also handed to writer, whose index ends with these
+        num_rows rows.
+        """
+        batches = list(_pack_batches(contents))
+        total_batches = len(batches)
+        logger.info(f"   Processing {len(contents)} {label} chunks in {total_batches} batches...")
+        # Allocated up front for known models, otherwise once the first batch returns
+        embeddings: Optional[np.ndarray] = None
+        if self._emb_dim is not None:
+            embeddings = np.empty((num_rows, self._emb_dim), dtype=np.float32)
+        
+        async def embed_batch(batch_num: int, start: int, batch: List[str]):
+            nonlocal embeddings
+            await asyncio.sleep(random.uniform(0, EMBEDDING_START_JITTER))
+            async with semaphore:
+                batch_start = time.perf_counter()
+                batch_embeddings = await self._get_embeddings_async(client, batch)
+                logger.info("   [EMBED] %s batch %d/%d: %d items (took %.2fs)",
+                            label.capitalize(), batch_num, total_batches, len(batch),
+                            time.perf_counter() - batch_start)
             
-            # Skip very large files to avoid timeout
-            if len(content) > 50000:  # ~50KB
-                logger.warning(f"   ⚠️  Skipping function parsing for large file ({len(content)} chars)")
-                # Still create file chunk but skip function parsing
-                chunks = [{
-                    "type": "file",
-                    "file_path": file_path,
-                    "content": content,
-                    "start_line": 1,
-                    "end_line": len(content.split('\n'))
-                }]
-                elapsed = time.time() - start_time
-                logger.info(f"   ✓ Completed {file_path} (took {elapsed:.2f}s, skipped function parsing)")
-                return chunks
-        except Exception as e:
-            logger.warning(f"   ✗ Failed to read {file_path}: {e}")
-            import traceback
-            logger.debug(traceback.format_exc())
-            return []
+            if embeddings is None:
+                embeddings = np.empty((num_rows, batch_embeddings.shape[1]), dtype=np.float32)
+            if target_rows is None:
+                embeddings[start:start + len(batch)] = batch_embeddings
+                filled = np.arange(start, start + len(batch))
+            else:
+                for offset, vector in enumerate(batch_embeddings):
+                    embeddings[target_rows[start + offset]] = vector
+                filled = np.array([row for i in range(start, start + len(batch)) for row in target_rows[i]])
+            if writer is not None:
+                writer.put(writer.num_rows - num_rows, embeddings, filled)
         
-        # Parse functions
+        await asyncio.gather(*(
+            embed_batch(batch_num, start, contents[start:end])
+            for batch_num, (start, end) in enumerate(batches, 1)
+        ))
+        return embeddings
+    
+    async def _embed_all_chunks(
+        self,
+        chunks: ChunkTable,
+        file_rows: np.ndarray,
+        function_rows: np.ndarray,
+        writers: Dict[str, _StreamingIndexWriter],
+        max_concurrent_batches: int = EMBEDDING_CONCURRENCY
+    ) -> List[np.ndarray]:
+        """Embed file and function chunks concurrently over one async client.
+        
+        At most max_concurrent_batches embedding requests are in flight at once.
+        """
+        semaphore = asyncio.Semaphore(max_concurrent_batches)
+        async with AsyncOpenAI(api_key=self._api_key) as client:
+            return await asyncio.gather(
+                self._embed_chunks(client, semaphore, chunks, file_rows, "file", writers.get("file")),
+                self._embed_chunks(client, semaphore, chunks, function_rows, "function", writers.get("function"))
+            )
+    
+    async def _embed_chunks(
+        self,
+        client: AsyncOpenAI,
+        semaphore: asyncio.Semaphore,
+        chunks: ChunkTable,
+        rows: np.ndarray,
+        label: str,
+        writer: Optional[_StreamingIndexWriter] = None
+    ) -> np.ndarray:
+        """Embed the given table rows, sending only one representative per near-duplicate group.
+        
+        Rows collapsed onto a representative get dup_of set to the
+        representative's table row, and reuse its vector.
+        """
+        if len(rows) == 0:
+            return np.array([], dtype=np.float32)
+        
+        contents = [self._load_chunk_text(chunks, row) for row in rows.tolist()]
+        representatives = _group_near_duplicates(contents)
+        unique_indices = sorted(set(representatives))
+        chunks.dup_of[rows] = np.where(np.array(representatives) == np.arange(len(rows)), -1, rows[representatives])
+        
+        if len(unique_indices) == len(contents):
+            return await self._embed_contents(client, semaphore, contents, label, len(rows), writer=writer)
+        
+        logger.info(f"   Collapsed {len(contents) - len(unique_indices)} near-duplicate {label} chunks")
+        rows_by_representative: Dict[int, List[int]] = {index: [] for index in unique_indices}
+        for i, rep_index in enumerate(representatives):
+            rows_by_representative[rep_index].append(i)
+        return await self._embed_contents(
+            client,
+            semaphore,
+            [contents[i] for i in unique_indices],
+            label,
+            len(rows),
+            [rows_by_representative[index] for index in unique_indices],
+            writer
+        )
+    
+    def _chunk_with_llm(self, file_path: str, content: str) -> ChunkTable:
+        """Chunk a file whose functions tree-sitter could not extract, using the LLM parser."""
+        start_time = time.perf_counter()
         functions = []
         try:
-            logger.debug(f"   [PARSE] Starting function parsing for {file_path}")
-            functions = self._parse_functions(file_path, content)
-            logger.info(f"   Found {len(functions)} functions")
+            functions = self._parse_functions_with_llm(file_path, content)
         except Exception as e:
-            logger.warning(f"   ✗ Failed to parse functions: {e}")
-            import traceback
-            logger.debug(traceback.format_exc())
+            logger.warning("   ✗ Failed to parse functions in %s: %s", file_path, e)
+            if logger.isEnabledFor(logging.DEBUG):
+                import traceback
+                logger.debug(traceback.format_exc())
             functions = []
         
-        # Create chunks
-        logger.debug(f"   [CHUNK] Creating chunks for {file_path}")
-        chunks = self._create_chunks(file_path, content, functions)
-        elapsed = time.time() - start_time
-        logger.info(f"   ✓ Completed {file_path} (took {elapsed:.2f}s, {len(chunks)} chunks)")
+        chunks = _create_chunks(file_path, content, functions)
+        logger.info("🤖 %s: %d functions, %d chunks (%.2fs)",
+                    file_path, len(functions), len(chunks), time.perf_counter() - start_time)
         return chunks
     
+    def _build_faiss_index(self, embeddings: np.ndarray) -> faiss.Index:
+        """Build an inner-product FAISS index for the given embeddings.
+        
+        Vectors are L2-normalized in place, so inner product equals cosine
+        similarity, and stored with the configured scalar quantizer (float16
+        by default), which shrinks index size and memory bandwidth at little
+        cost in ranking quality. Small codebases use exact search; large ones
+        switch to an HNSW graph so query cost grows logarithmically with size.
+        Exact unquantized (IndexFlatIP) indices are filled on a GPU when one
+        is available.
+        """
+        num_vectors, dimension = embeddings.shape
+        if self._emb_dim is not None and dimension != self._emb_dim:
+            raise ValueError(f"Expected {self._emb_dim}-dimensional embeddings for {self.embedding_model}, got {dimension}")
+        faiss.normalize_L2(embeddings)
+        index = self._new_faiss_index(num_vectors, dimension)
+        if self._uses_gpu_build(num_vectors):
+            gpu_built = self._build_on_gpu(index, embeddings)
+            if gpu_built is not None:
+                return gpu_built
+        with faiss_threads(os.cpu_count() or 1):
+            index.train(embeddings)
+            index.add(embeddings)
+        return index
+    
+    def _new_faiss_index(self, num_vectors: int, dimension: int) -> faiss.Index:
+        """Create the empty index _build_faiss_index uses for num_vectors vectors."""
+        quantizer = VECTOR_QUANTIZERS[self.vector_quantization]
+        if num_vectors >= HNSW_MIN_VECTORS:
+            logger.debug(f"   Creating HNSW index with dimension {dimension} ({num_vectors} vectors, {self.vector_quantization})")
+            if quantizer is None:
+                index = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexHNSWSQ(dimension, quantizer, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        else:
+            logger.debug(f"   Creating flat index with dimension {dimension} ({num_vectors} vectors, {self.vector_quantization})")
+            if quantizer is None:
+                index = faiss.IndexFlatIP(dimension)
+            else:
+                index = faiss.IndexScalarQuantizer(dimension, quantizer, faiss.METRIC_INNER_PRODUCT)
+        return index
+    
+    def _can_stream_index(self, num_vectors: int) -> bool:
+        """Whether an index of num_vectors can be filled while embedding, i.e. without training or a GPU build.
+        
+        float16 and unquantized storage need no training; 8-bit ranges are
+        learned from all vectors, so those indices are built afterwards.
+        """
+        if VECTOR_QUANTIZERS[self.vector_quantization] not in (None, faiss.ScalarQuantizer.QT_fp16):
+            return False
+        return not self._uses_gpu_build(num_vectors)
+    
+    def _uses_gpu_build(self, num_vectors: int) -> bool:
+        """Whether _build_faiss_index fills an index of num_vectors on the GPU.
+        
+        Only exact unquantized indices (IndexFlatIP) are moved to the GPU;
+        scalar-quantized and HNSW indices are always built on the CPU.
+        """
+        return (
+            VECTOR_QUANTIZERS[self.vector_quantization] is None
+            and num_vectors < HNSW_MIN_VECTORS
+            and hasattr(faiss, "StandardGpuResources")
+            and faiss.get_num_gpus() > 0
+        )
+    
+    def _build_on_gpu(self, index: faiss.Index, embeddings: np.ndarray) -> Optional[faiss.Index]:
+        """Train and fill an empty index on GPU 0, returning it as a CPU index for write_index.
+        
+        Returns None without a GPU build of FAISS, without a visible GPU, or
+        for index types FAISS cannot move to the GPU; the caller then builds
+        on the CPU.
+        """
+        if not hasattr(faiss, "StandardGpuResources") or faiss.get_num_gpus() == 0:
+            return None
+        try:
+            gpu_resources = faiss.StandardGpuResources()
+            gpu_index = faiss.index_cpu_to_gpu(gpu_resources, 0, index)
+            gpu_index.train(embeddings)
+            gpu_index.add(embeddings)
+            logger.debug(f"   Built index on GPU ({len(embeddings)} vectors)")
+            return faiss.index_gpu_to_cpu(gpu_index)
+        except RuntimeError as e:
+            logger.debug(f"   GPU build not possible, building on CPU: {e}")
+            return None
+    
+    def _load_previous_index(self, output_path: Path) -> Optional[Dict[str, Any]]:
+        """Load the manifest, chunks and vectors of a previous run in output_path.
+        
+        Returns None when nothing can be reused: no previous run, one built
+        with a different embedding model or quantization, or files that do
+        not agree with each other.
+        """
+        manifest_path = output_path / MANIFEST_FILE
+        metadata_path = output_path / "metadata.json"
+        if not manifest_path.exists() or not metadata_path.exists():
+            return None
+        try:
+            manifest = orjson.loads(manifest_path.read_bytes())
+            if (manifest.get("embedding_model") != self.embedding_model
+                    or manifest.get("vector_quantization") != self.vector_quantization):
+                logger.info("   Previous index used different settings, re-indexing everything")
+                return None
+            
+            chunks = orjson.loads(metadata_path.read_bytes()).get("chunks", [])
+            vectors = {}
+            for chunk_type in CHUNK_TYPES:
+                num_chunks = sum(1 for c in chunks if c["type"] == chunk_type)
+                index_file = output_path / f"{chunk_type}_index.faiss"
+                if num_chunks == 0:
+                    continue
+                index = faiss.read_index(str(index_file))
+                if index.ntotal != num_chunks:
+                    logger.warning(f"   {index_file} does not match metadata, re-indexing everything")
+                    return None
+                vectors[chunk_type] = index.reconstruct_n(0, index.ntotal)
+        except Exception as e:
+            logger.warning(f"   Could not load previous index, re-indexing everything: {e}")
+            return None
+        return {"files": manifest.get("files", {}), "chunks": chunks, "vectors": vectors}
+    
+    def _split_changed_files(
+        self,
+        files: List[str],
+        previous_files: Dict[str, Dict[str, Any]]
+    ) -> Tuple[List[str], List[str], Dict[str, Dict[str, Any]]]:
+        """Split files into (changed, unchanged) against the previous manifest.
+        
+        Size and mtime are compared first; a file whose size matches but
+        whose mtime moved is compared by SHA-256 before it counts as changed.
+        Also returns the new manifest entry of every file that could be stat'ed.
+        """
+        changed, unchanged = [], []
+        entries: Dict[str, Dict[str, Any]] = {}
+        for file_path in files:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                changed.append(file_path)
+                continue
+            entry = entries[file_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            previous = previous_files.get(file_path)
+            if previous is not None and previous["size"] == stat.st_size and (
+                previous["mtime_ns"] == stat.st_mtime_ns
+                or _file_sha256(file_path, stat.st_size) == previous["sha256"]
+            ):
+                entry["sha256"] = previous["sha256"]
+                unchanged.append(file_path)
+            else:
+                changed.append(file_path)
+        return changed, unchanged, entries
+    
+    def _reuse_chunks(
+        self,
+        previous: Dict[str, Any],
+        unchanged: List[str]
+    ) -> Tuple[ChunkTable, Dict[str, np.ndarray]]:
+        """Copy the chunks and vectors of unchanged files out of the previous run.
+        
+        Returns the chunks as a table and, per chunk type, their vectors in
+        table order.
+        """
+        old_chunks = previous["chunks"]
+        reused = [i for file_path in unchanged for i in previous["files"][file_path]["chunks"]]
+        table = ChunkTable.from_dicts([old_chunks[i] for i in reused])
+        
+        # An old chunk's position among chunks of its type is its old vector id
+        old_positions = []
+        type_counts = dict.fromkeys(CHUNK_TYPES, 0)
+        for chunk in old_chunks:
+            old_positions.append(type_counts[chunk["type"]])
+            type_counts[chunk["type"]] += 1
+        
+        # dup_of pointed at old vector ids; keep it only if the representative was reused too
+        row_of = {(old_chunks[i]["type"], old_positions[i]): row for row, i in enumerate(reused)}
+        table.dup_of[:] = [row_of.get((old_chunks[i]["type"], old_chunks[i].get("dup_of")), -1) for i in reused]
+        
+        vectors = {}
+        for chunk_type in CHUNK_TYPES:
+            positions = [old_positions[i] for i in reused if old_chunks[i]["type"] == chunk_type]
+            if positions:
+                vectors[chunk_type] = previous["vectors"][chunk_type][positions]
+        return table, vectors
+    
+    def _write_manifest(self, output_path: Path, chunks: ChunkTable, entries: Dict[str, Dict[str, Any]]):
+        """Record size, mtime, hash and metadata chunk ids of every indexed file."""
+        files: Dict[str, Dict[str, Any]] = {}
+        for row, file_path in enumerate(chunks.file_paths):
+            if file_path not in entries:
+                continue  # Could not be stat'ed; it is simply re-indexed next time
+            entry = files.get(file_path)
+            if entry is None:
+                entry = files[file_path] = {**entries[file_path], "chunks": []}
+            entry["chunks"].append(row)
+            if chunks.types[row] == CHUNK_FILE:
+                entry.setdefault("sha256", chunks.content_hashes[row])
+        
+        manifest = {
+            "embedding_model": self.embedding_model,
+            "vector_quantization": self.vector_quantization,
+            "files": files
+        }
+        (output_path / MANIFEST_FILE).write_bytes(orjson.dumps(manifest))
+    
     def index(
         self, 
         codebase_path: str, 
         output_dir: str = "index_data",
-        max_workers: int = 32
+        max_workers: int = 32,
+        incremental: bool = True,
+        max_concurrent_batches: int = EMBEDDING_CONCURRENCY
     ) -> Dict[str, Any]:
-        """Index a codebase with parallel processing."""
+        """Index a codebase with parallel processing.
+        
+        Reading and tree-sitter parsing run in one process per core;
+        max_workers threads serve the files that need the LLM parser, and
+        up to max_concurrent_batches embedding requests run concurrently.
+        With incremental, files unchanged since the previous run in
+        output_dir keep their chunks and vectors and are not re-embedded.
+        """
         logger.info(f"🚀 Starting indexing for: {codebase_path}")
-        logger.info(f"⚙️  Using {max_workers} parallel workers")
+        parse_workers = os.cpu_count() or 1
+        logger.info(f"⚙️  Using {parse_workers} parse processes and {max_workers} LLM parsing threads")
         total_start_time = time.time()
         
         # Create output directory
         output_path = Path(output_dir)
         output_path.mkdir(exist_ok=True)
         logger.info(f"📂 Output directory: {output_path}")
+        self._emb_cache_path = output_path / EMBEDDING_CACHE_FILE
         
         # Get all files
         logger.info(f"🔍 Scanning for supported files...")
@@ -246,87 +1260,126 @@ class CodeIndexer:
         if len(files) > 0:
             logger.info(f"   First few files: {files[:5]}")
         
-        all_chunks = []
+        previous = self._load_previous_index(output_path) if incremental else None
+        changed, unchanged, file_entries = self._split_changed_files(
+            files, previous["files"] if previous else {}
+        )
+        if previous:
+            reused_chunks, reused_vectors = self._reuse_chunks(previous, unchanged)
+            del previous
+        else:
+            reused_chunks, reused_vectors = ChunkTable.empty(), {}
+        if unchanged:
+            logger.info(f"♻️  Reusing {len(reused_chunks)} chunks from {len(unchanged)} unchanged files")
+        
+        # Reused chunks come first, so their rows are stable when new tables are appended
+        tables: List[ChunkTable] = [reused_chunks]
         
         # Process files in parallel
         logger.info(f"🔄 Starting parallel file processing...")
         process_start = time.time()
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Submit all tasks
+        # Files whose functions tree-sitter could not extract, with their content
+        llm_files: List[Tuple[str, str]] = []
+        # Canonical text of every file read whole, shared by all its chunks
+        file_text: Dict[str, str] = {}
+        completed = 0
+        
+        # Reading and tree-sitter parsing are CPU-bound, so they get real processes
+        with ProcessPoolExecutor(max_workers=parse_workers) as executor:
             future_to_file = {
-                executor.submit(self._process_single_file, file_path, i, len(files)): file_path
-                for i, file_path in enumerate(files)
+                executor.submit(_read_and_parse, file_path, i, len(changed)): file_path
+                for i, file_path in enumerate(changed)
             }
             
-            # Collect results as they complete
-            completed = 0
             for future in as_completed(future_to_file):
                 file_path = future_to_file[future]
-                completed += 1
                 try:
-                    chunks = future.result()
-                    all_chunks.extend(chunks)
-                    logger.info(f"   ✓ Progress: {completed}/{len(files)} files processed")
+                    chunks, content = future.result()
                 except Exception as e:
-                    logger.error(f"   ✗ File {file_path} generated an exception: {e}")
-                    import traceback
-                    logger.debug(traceback.format_exc())
+                    completed += 1
+                    logger.error("   ✗ File %s generated an exception: %s", file_path, e)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        import traceback
+                        logger.debug(traceback.format_exc())
+                    continue
+                if content is not None:
+                    file_text[file_path] = content
+                if chunks is None:
+                    llm_files.append((file_path, content))
+                    continue
+                completed += 1
+                tables.append(chunks)
+                logger.debug("   ✓ Progress: %d/%d files processed", completed, len(changed))
+        
+        # LLM parsing waits on the network, so threads are enough
+        if llm_files:
+            logger.info(f"🤖 Parsing {len(llm_files)} files with the LLM...")
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                future_to_file = {
+                    executor.submit(self._chunk_with_llm, file_path, content): file_path
+                    for file_path, content in llm_files
+                }
+                
+                for future in as_completed(future_to_file):
+                    file_path = future_to_file[future]
+                    completed += 1
+                    try:
+                        tables.append(future.result())
+                        logger.debug("   ✓ Progress: %d/%d files processed", completed, len(changed))
+                    except Exception as e:
+                        logger.error("   ✗ File %s generated an exception: %s", file_path, e)
+                        if logger.isEnabledFor(logging.DEBUG):
+                            import traceback
+                            logger.debug(traceback.format_exc())
         
         process_time = time.time() - process_start
         logger.info(f"✅ File processing completed (took {process_time:.2f}s)")
         
-        logger.info(f"📦 Created {len(all_chunks)} chunks total")
+        chunks = ChunkTable.concat(tables)
+        logger.info(f"📦 Created {len(chunks)} chunks total")
         
         # Separate file and function chunks
-        file_chunks = [c for c in all_chunks if c["type"] == "file"]
-        function_chunks = [c for c in all_chunks if c["type"] == "function"]
+        file_rows = chunks.rows_of(CHUNK_FILE)
+        function_rows = chunks.rows_of(CHUNK_FUNCTION)
         
-        logger.info(f"   File chunks: {len(file_chunks)}")
-        logger.info(f"   Function chunks: {len(function_chunks)}")
+        logger.info(f"   File chunks: {len(file_rows)}")
+        logger.info(f"   Function chunks: {len(function_rows)}")
         
-        # Get embeddings in batches
+        # Fill the FAISS indices on background threads as embeddings arrive
+        writers: Dict[str, _StreamingIndexWriter] = {}
+        for chunk_type, rows in (("file", file_rows), ("function", function_rows)):
+            if len(rows) > 0 and self._can_stream_index(len(rows)):
+                writer = writers[chunk_type] = _StreamingIndexWriter(
+                    partial(self._new_faiss_index, len(rows)), len(rows)
+                )
+                reused = reused_vectors.get(chunk_type)
+                if reused is not None:
+                    writer.put(0, reused, np.arange(len(reused)))
+        
+        # Get embeddings in batches, for the chunks of changed files only
         logger.info("🔢 Generating embeddings...")
         embed_start = time.time()
-        file_contents = [c["content"] for c in file_chunks]
-        function_contents = [c["content"] for c in function_chunks]
-        
-        # Batch embeddings (OpenAI supports up to 2048 items per batch)
-        batch_size = 100
-        file_embeddings_list = []
-        if file_chunks:
-            total_batches = (len(file_contents) - 1) // batch_size + 1
-            logger.info(f"   Processing {len(file_contents)} file chunks in {total_batches} batches...")
-            for i in range(0, len(file_contents), batch_size):
-                batch = file_contents[i:i+batch_size]
-                batch_num = i // batch_size + 1
-                logger.info(f"   [EMBED] Processing file embeddings batch {batch_num}/{total_batches} ({len(batch)} items)")
-                batch_start = time.time()
-                batch_embeddings = self._get_embeddings(batch)
-                batch_time = time.time() - batch_start
-                file_embeddings_list.append(batch_embeddings)
-                logger.info(f"   [EMBED] Batch {batch_num} completed (took {batch_time:.2f}s)")
-            file_embeddings = np.vstack(file_embeddings_list) if file_embeddings_list else np.array([], dtype=np.float32)
-        else:
-            file_embeddings = np.array([], dtype=np.float32)
-        
-        function_embeddings_list = []
-        if function_chunks:
-            total_batches = (len(function_contents) - 1) // batch_size + 1
-            logger.info(f"   Processing {len(function_contents)} function chunks in {total_batches} batches...")
-            for i in range(0, len(function_contents), batch_size):
-                batch = function_contents[i:i+batch_size]
-                batch_num = i // batch_size + 1
-                logger.info(f"   [EMBED] Processing function embeddings batch {batch_num}/{total_batches} ({len(batch)} items)")
-                batch_start = time.time()
-                batch_embeddings = self._get_embeddings(batch)
-                batch_time = time.time() - batch_start
-                function_embeddings_list.append(batch_embeddings)
-                logger.info(f"   [EMBED] Batch {batch_num} completed (took {batch_time:.2f}s)")
-            function_embeddings = np.vstack(function_embeddings_list) if function_embeddings_list else np.array([], dtype=np.float32)
-        else:
-            function_embeddings = np.array([], dtype=np.float32)
+        self._file_text = file_text
+        try:
+            new_file_embeddings, new_function_embeddings = asyncio.run(self._embed_all_chunks(
+                chunks,
+                file_rows[file_rows >= len(reused_chunks)],
+                function_rows[function_rows >= len(reused_chunks)],
+                writers,
+                max_concurrent_batches
+            ))
+        finally:
+            # Chunk text is not needed past this point
+            self._file_bytes.cache_clear()
+            file_text.clear()
+            self._file_text = {}
+            streamed_indices = {chunk_type: writer.close() for chunk_type, writer in writers.items()}
+            # Also on failure: a later index() into another output_dir must not reuse this connection
+            self._close_embedding_cache()
         
+        file_embeddings = _merge_vectors(reused_vectors.get("file"), new_file_embeddings)
+        function_embeddings = _merge_vectors(reused_vectors.get("function"), new_function_embeddings)
         embed_time = time.time() - embed_start
         logger.info(f"   File embeddings shape: {file_embeddings.shape}")
         logger.info(f"   Function embeddings shape: {function_embeddings.shape}")
@@ -337,24 +1390,27 @@ class CodeIndexer:
         index_start = time.time()
         
         if len(file_embeddings) > 0:
-            dimension = file_embeddings.shape[1]
-            logger.debug(f"   Creating file index with dimension {dimension}")
-            file_index = faiss.IndexFlatL2(dimension)
-            file_index.add(file_embeddings)
+            file_index = streamed_indices.get("file")
+            if file_index is None:
+                file_index = self._build_faiss_index(file_embeddings)
             index_file = output_path / "file_index.faiss"
             logger.debug(f"   Writing file index to {index_file}")
             faiss.write_index(file_index, str(index_file))
             logger.info(f"   ✓ Saved file index with {file_index.ntotal} vectors")
+        else:
+            # Do not leave a previous run's vectors next to metadata without file chunks
+            (output_path / "file_index.faiss").unlink(missing_ok=True)
         
         if len(function_embeddings) > 0:
-            dimension = function_embeddings.shape[1]
-            logger.debug(f"   Creating function index with dimension {dimension}")
-            function_index = faiss.IndexFlatL2(dimension)
-            function_index.add(function_embeddings)
+            function_index = streamed_indices.get("function")
+            if function_index is None:
+                function_index = self._build_faiss_index(function_embeddings)
             index_file = output_path / "function_index.faiss"
             logger.debug(f"   Writing function index to {index_file}")
             faiss.write_index(function_index, str(index_file))
             logger.info(f"   ✓ Saved function index with {function_index.ntotal} vectors")
+        else:
+            (output_path / "function_index.faiss").unlink(missing_ok=True)
         
         index_time = time.time() - index_start
         logger.info(f"   Index building took {index_time:.2f}s")
@@ -364,16 +1420,19 @@ class CodeIndexer:
         metadata_start = time.time()
         metadata = {
             "codebase_path": codebase_path,
+            "metric": METRIC_IP_NORMALIZED,
+            "vector_quantization": self.vector_quantization,
             "total_files": len(files),
-            "total_chunks": len(all_chunks),
-            "file_chunks": len(file_chunks),
-            "function_chunks": len(function_chunks),
-            "chunks": all_chunks
+            "total_chunks": len(chunks),
+            "file_chunks": len(file_rows),
+            "function_chunks": len(function_rows),
+            "chunks": chunks.to_dicts()
         }
         
+        # Compact orjson output: far faster than json.dump(indent=2) and a fraction of the size
         metadata_path = output_path / "metadata.json"
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        metadata_path.write_bytes(orjson.dumps(metadata))
+        self._write_manifest(output_path, chunks, file_entries)
         
         metadata_time = time.time() - metadata_start
         logger.info(f"   ✓ Saved metadata to {metadata_path} (took {metadata_time:.2f}s)")
@@ -382,16 +1441,16 @@ class CodeIndexer:
         logger.info(f"✅ Indexing completed! Total time: {total_time:.2f}s")
         logger.info(f"   Summary:")
         logger.info(f"     - Files: {len(files)}")
-        logger.info(f"     - File chunks: {len(file_chunks)}")
-        logger.info(f"     - Function chunks: {len(function_chunks)}")
-        logger.info(f"     - Total chunks: {len(all_chunks)}")
+        logger.info(f"     - File chunks: {len(file_rows)}")
+        logger.info(f"     - Function chunks: {len(function_rows)}")
+        logger.info(f"     - Total chunks: {len(chunks)}")
         
         return {
             "status": "success",
             "total_files": len(files),
-            "total_chunks": len(all_chunks),
-            "file_chunks": len(file_chunks),
-            "function_chunks": len(function_chunks),
+            "total_chunks": len(chunks),
+            "file_chunks": len(file_rows),
+            "function_chunks": len(function_rows),
             "output_dir": str(output_path)
         }
 
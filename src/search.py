@@ -1,15 +1,132 @@
 """Search service for indexed codebase."""
-import json
 import os
 import logging
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from openai import OpenAI
 import faiss
 import numpy as np
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Candidate list size for HNSW indices (see CodeIndexer._build_faiss_index)
+HNSW_EF_SEARCH = 64
+
+# Vector metric recorded in metadata.json; indices without a marker predate it and use L2
+METRIC_IP_NORMALIZED = "ip_normalized"
+METRIC_L2 = "l2"
+
+# Number of distinct (question, index_type, top_k) results kept per searcher
+SEARCH_CACHE_SIZE = 512
+
+
+@contextmanager
+def faiss_threads(num_threads: int):
+    """Temporarily set the number of OpenMP threads FAISS uses."""
+    previous = faiss.omp_get_max_threads()
+    faiss.omp_set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        faiss.omp_set_num_threads(previous)
+
+
+@lru_cache(maxsize=128)
+def _read_file_cached(file_path: str, mtime_ns: int) -> str:
+    """Read a file from disk; keyed on mtime so edits invalidate the entry."""
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+@lru_cache(maxsize=128)
+def _read_lines_cached(file_path: str, mtime_ns: int) -> Tuple[str, ...]:
+    """Split a file into lines once, so adjacent chunks of the same file reuse it."""
+    return tuple(_read_file_cached(file_path, mtime_ns).split('\n'))
+
+
+def load_chunk_text(file_path: str, start_line: Optional[int], end_line: Optional[int]) -> str:
+    """Re-slice a chunk's text (1-based, inclusive line span) from the file on disk.
+    
+    Metadata stores only spans, not chunk content. Returns "" if the file
+    can no longer be read.
+    """
+    try:
+        lines = _read_lines_cached(file_path, os.stat(file_path).st_mtime_ns)
+    except OSError as e:
+        logger.warning(f"Failed to read chunk text from {file_path}: {e}")
+        return ""
+    start = (start_line or 1) - 1
+    end = end_line if end_line is not None else len(lines)
+    return '\n'.join(lines[start:end])
+
+
+@dataclass(slots=True, frozen=True)
+class SearchHit:
+    """A single search result."""
+    file_path: str
+    content: str
+    distance: float
+    type: str
+    start_line: Optional[int]
+    end_line: Optional[int]
+    function_name: Optional[str] = None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert to the JSON shape returned by the search tool."""
+        result = {
+            "file_path": self.file_path,
+            "content": self.content,
+            "distance": self.distance,
+            "type": self.type
+        }
+        if self.type == "function":
+            result["function_name"] = self.function_name
+        result["start_line"] = self.start_line
+        result["end_line"] = self.end_line
+        return result
+
+
+@dataclass
+class ChunkColumns:
+    """Column-oriented chunk metadata for one index; row i matches FAISS vector i."""
+    file_paths: List[str] = field(default_factory=list)
+    # None for chunks written without inline content; see content()
+    contents: List[Optional[str]] = field(default_factory=list)
+    start_lines: List[Optional[int]] = field(default_factory=list)
+    end_lines: List[Optional[int]] = field(default_factory=list)
+    function_names: List[Optional[str]] = field(default_factory=list)
+    
+    def __len__(self) -> int:
+        return len(self.file_paths)
+    
+    def append(self, chunk: Dict[str, Any]):
+        """Append one metadata chunk, filling in file-level line defaults."""
+        content = chunk.get("content")
+        self.file_paths.append(chunk.get("file_path"))
+        self.contents.append(content)
+        if chunk.get("type") == "file":
+            self.start_lines.append(chunk.get("start_line", 1))
+            end_line = chunk.get("end_line")
+            if end_line is None:
+                # Older metadata may lack end_line; count lines without splitting
+                end_line = (content or "").count('\n') + 1
+            self.end_lines.append(end_line)
+        else:
+            self.start_lines.append(chunk.get("start_line"))
+            self.end_lines.append(chunk.get("end_line"))
+        self.function_names.append(chunk.get("function_name"))
+    
+    def content(self, i: int) -> str:
+        """Text of row i: inline content from older metadata, else re-sliced from disk."""
+        content = self.contents[i]
+        if content is None:
+            return load_chunk_text(self.file_paths[i], self.start_lines[i], self.end_lines[i])
+        return content
+
 
 class CodeSearcher:
     """Search indexed codebase using FAISS."""
@@ -22,41 +139,85 @@ class CodeSearcher:
     ):
         self.index_dir = Path(index_dir)
         self.embedding_model = embedding_model
-        self.client = OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"))
+        self._api_key = api_key
+        # A single query vector with a small top_k is cheaper than the OpenMP
+        # fork/join it would trigger; batched paths opt back in via faiss_threads
+        faiss.omp_set_num_threads(1)
         
-        self.file_index = None
-        self.function_index = None
         self.metadata = None
+        self.metric = METRIC_L2
+        # Chunk columns by type, in the same order as the vectors in each FAISS index
+        self._columns: Dict[str, ChunkColumns] = {"file": ChunkColumns(), "function": ChunkColumns()}
+        # Per-instance result cache; a re-index creates a new searcher, which drops it
+        self._search_cached = lru_cache(maxsize=SEARCH_CACHE_SIZE)(self._search)
+        self._file_content_by_path: Dict[str, str] = {}
         
         self._load_indices()
     
     def _load_indices(self):
-        """Load FAISS indices and metadata."""
+        """Load metadata; FAISS indices are loaded lazily on first use."""
         try:
             # Load metadata
             metadata_path = self.index_dir / "metadata.json"
             if metadata_path.exists():
-                with open(metadata_path, 'r', encoding='utf-8') as f:
-                    self.metadata = json.load(f)
+                self.metadata = orjson.loads(metadata_path.read_bytes())
+                self.metric = self.metadata.get("metric", METRIC_L2)
                 logger.info(f"📂 Loaded metadata with {len(self.metadata.get('chunks', []))} chunks")
+                for chunk in self.metadata.get("chunks", []):
+                    columns = self._columns.get(chunk.get("type"))
+                    if columns is not None:
+                        columns.append(chunk)
+                    if chunk.get("type") == "file" and "content" in chunk:
+                        self._file_content_by_path[chunk.get("file_path")] = chunk["content"]
             else:
                 logger.warning(f"Metadata file not found: {metadata_path}")
-                return
-            
-            # Load file index
-            file_index_path = self.index_dir / "file_index.faiss"
-            if file_index_path.exists():
-                self.file_index = faiss.read_index(str(file_index_path))
-                logger.info(f"📁 Loaded file index with {self.file_index.ntotal} vectors")
-            
-            # Load function index
-            function_index_path = self.index_dir / "function_index.faiss"
-            if function_index_path.exists():
-                self.function_index = faiss.read_index(str(function_index_path))
-                logger.info(f"🔧 Loaded function index with {self.function_index.ntotal} vectors")
-                
         except Exception as e:
-            logger.error(f"Failed to load indices: {e}")
+            logger.error(f"Failed to load metadata: {e}")
+    
+    @cached_property
+    def client(self) -> OpenAI:
+        """OpenAI client, created on the first query that needs an embedding."""
+        return OpenAI(api_key=self._api_key or os.getenv("OPENAI_API_KEY"))
+    
+    @cached_property
+    def file_index(self) -> Optional[faiss.Index]:
+        """File-level FAISS index, loaded on first use."""
+        index = self._load_index(self.index_dir / "file_index.faiss")
+        if index is not None:
+            logger.info(f"📁 Loaded file index with {index.ntotal} vectors")
+        return index
+    
+    @cached_property
+    def function_index(self) -> Optional[faiss.Index]:
+        """Function-level FAISS index, loaded on first use."""
+        index = self._load_index(self.index_dir / "function_index.faiss")
+        if index is not None:
+            logger.info(f"🔧 Loaded function index with {index.ntotal} vectors")
+        return index
+    
+    def _load_index(self, index_path: Path) -> Optional[faiss.Index]:
+        """Load a FAISS index if present, returning None if missing or unreadable."""
+        if not self.metadata or not index_path.exists():
+            return None
+        try:
+            return self._read_index(index_path)
+        except Exception as e:
+            logger.error(f"Failed to load index {index_path}: {e}")
+            return None
+    
+    def _read_index(self, index_path: Path) -> faiss.Index:
+        """Read a FAISS index, memory-mapping its vector codes where FAISS supports it.
+        
+        IO_FLAG_MMAP_IFC maps the codes of flat-code indices (IndexFlat*,
+        IndexScalarQuantizer) so they are paged in lazily. FAISS builds
+        without the flag, or indices it cannot map, are read into RAM.
+        """
+        if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+            try:
+                return faiss.read_index(str(index_path), faiss.IO_FLAG_MMAP_IFC)
+            except RuntimeError as e:
+                logger.debug(f"mmap not supported for {index_path}, loading into memory: {e}")
+        return faiss.read_index(str(index_path))
     
     def _get_embedding(self, text: str) -> np.ndarray:
         """Get embedding for a single text."""
@@ -64,78 +225,126 @@ class CodeSearcher:
             model=self.embedding_model,
             input=[text]
         )
-        return np.array([response.data[0].embedding], dtype=np.float32)
+        embedding = np.asarray(response.data[0].embedding, dtype=np.float32).reshape(1, -1)
+        if self.metric == METRIC_IP_NORMALIZED:
+            # Match the indexed vectors; OpenAI embeddings are already (nearly) unit-norm
+            faiss.normalize_L2(embedding)
+        return embedding
     
-    def search(self, question: str, index_type: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        """Search the indexed codebase."""
-        if not self.metadata:
-            return []
-        
-        # Get query embedding
-        query_embedding = self._get_embedding(question)
-        
-        # Select index
+    def _get_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Get embeddings for a list of texts in a single API call."""
+        response = self.client.embeddings.create(
+            model=self.embedding_model,
+            input=texts
+        )
+        embeddings = np.empty((len(response.data), len(response.data[0].embedding)), dtype=np.float32)
+        for i, item in enumerate(response.data):
+            embeddings[i] = item.embedding
+        if self.metric == METRIC_IP_NORMALIZED:
+            faiss.normalize_L2(embeddings)
+        return embeddings
+    
+    def _select_index(self, index_type: str) -> Optional[faiss.Index]:
+        """Return the FAISS index for index_type, or None if invalid or empty."""
         if index_type == "file":
             index = self.file_index
-            chunk_type = "file"
         elif index_type == "function":
             index = self.function_index
-            chunk_type = "function"
         else:
             logger.error(f"Invalid index_type: {index_type}")
-            return []
+            return None
         
         if index is None or index.ntotal == 0:
             logger.warning(f"Index {index_type} is not available or empty")
-            return []
+            return None
+        return index
+    
+    def _run_search(
+        self,
+        index: faiss.Index,
+        chunk_type: str,
+        query_embeddings: np.ndarray,
+        top_k: int
+    ) -> List[Tuple[SearchHit, ...]]:
+        """Search one or more query vectors and map the matches to SearchHits."""
+        k = min(top_k, index.ntotal)
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = max(HNSW_EF_SEARCH, k)
+        distances, indices = index.search(query_embeddings, k)
         
-        # Search
-        distances, indices = index.search(query_embedding, min(top_k, index.ntotal))
+        # FAISS pads missing hits with index -1
+        columns = self._columns[chunk_type]
+        return [
+            tuple(
+                SearchHit(
+                    columns.file_paths[idx],
+                    columns.content(idx),
+                    distance,
+                    chunk_type,
+                    columns.start_lines[idx],
+                    columns.end_lines[idx],
+                    columns.function_names[idx],
+                )
+                for idx, distance in zip(index_row, distance_row)
+                if 0 <= idx < len(columns)
+            )
+            for index_row, distance_row in zip(indices.tolist(), distances.tolist())
+        ]
+    
+    def search(self, question: str, index_type: str, top_k: int = 5) -> List[SearchHit]:
+        """Search the indexed codebase.
         
-        # Get results
-        results = []
-        chunks = self.metadata.get("chunks", [])
+        Results are ordered best match first. For inner-product indices the
+        distance holds the cosine similarity (higher is better).
+        Repeated queries are served from an in-process LRU cache.
+        """
+        return list(self._search_cached(question, index_type, top_k))
+    
+    def _search(self, question: str, index_type: str, top_k: int) -> Tuple[SearchHit, ...]:
+        """Embed the question and run the FAISS search (uncached)."""
+        if not self.metadata:
+            return ()
         
-        # Filter chunks by type
-        typed_chunks = [c for c in chunks if c.get("type") == chunk_type]
+        index = self._select_index(index_type)
+        if index is None:
+            return ()
         
-        for i, idx in enumerate(indices[0]):
-            if idx < len(typed_chunks):
-                chunk = typed_chunks[idx]
-                result = {
-                    "file_path": chunk.get("file_path"),
-                    "content": chunk.get("content"),
-                    "distance": float(distances[0][i]),
-                    "type": chunk_type
-                }
-                
-                if chunk_type == "function":
-                    result["function_name"] = chunk.get("function_name")
-                    result["start_line"] = chunk.get("start_line")
-                    result["end_line"] = chunk.get("end_line")
-                else:
-                    result["start_line"] = chunk.get("start_line", 1)
-                    result["end_line"] = chunk.get("end_line", len(chunk.get("content", "").split('\n')))
-                
-                results.append(result)
+        query_embedding = self._get_embedding(question)
+        results = self._run_search(index, index_type, query_embedding, top_k)[0]
         
         logger.info(f"🔍 Found {len(results)} results for '{question}' in {index_type} index")
         return results
     
+    def search_many(self, questions: List[str], index_type: str, top_k: int = 5) -> List[List[SearchHit]]:
+        """Search several questions with one embedding call and one batched FAISS search.
+        
+        Unlike single searches, the batched FAISS search runs on all cores.
+        """
+        if not self.metadata or not questions:
+            return [[] for _ in questions]
+        
+        index = self._select_index(index_type)
+        if index is None:
+            return [[] for _ in questions]
+        
+        query_embeddings = self._get_embeddings(questions)
+        with faiss_threads(os.cpu_count() or 1):
+            results = self._run_search(index, index_type, query_embeddings, top_k)
+        
+        logger.info(f"🔍 Ran {len(questions)} batched searches in {index_type} index")
+        return [list(hits) for hits in results]
+    
     def list_file_content(self, file_path: str) -> str:
         """Get full content of a file from metadata."""
         if not self.metadata:
             return ""
         
-        chunks = self.metadata.get("chunks", [])
-        for chunk in chunks:
-            if chunk.get("type") == "file" and chunk.get("file_path") == file_path:
-                return chunk.get("content", "")
+        if file_path in self._file_content_by_path:
+            return self._file_content_by_path[file_path]
         
         # If not in metadata, try to read from filesystem
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
+            return _read_file_cached(file_path, os.stat(file_path).st_mtime_ns)
         except:
             return ""
 
@@ -1,38 +1,80 @@
 """Simple file system tools for the agent."""
+import fnmatch
+import mmap
 import os
-import subprocess
+import re
+import stat
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import Dict, Any
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple
 
+__all__ = [
+    "cat_file",
+    "cat_file_mmap",
+    "iter_mmap",
+    "ls_directory",
+    "find_files",
+    "set_searcher",
+    "search_codebase",
+    "list_file_content",
+    "TOOLS",
+    "OPENAI_TOOLS",
+]
 
-def cat_file(file_path: str) -> Dict[str, Any]:
-    """Read and return the contents of a file.
+
+# Lines returned by cat_file when the caller does not ask for a range
+CAT_DEFAULT_LIMIT = 2000
+
+
+def cat_file(file_path: str, offset: int = 0, limit: Optional[int] = CAT_DEFAULT_LIMIT) -> Dict[str, Any]:
+    """Read and return the contents of a file, or a range of its lines.
     
     Args:
         file_path: Path to the file to read
+        offset: Number of lines to skip from the start of the file
+        limit: Maximum number of lines to return; None returns the rest of the file
         
     Returns:
-        Dict with 'success', 'content', and 'error' fields
+        Dict with 'success', 'content', 'truncated', and 'error' fields.
+        'truncated' is true when the file has more lines after the returned range.
     """
+    if offset < 0 or (limit is not None and limit < 0):
+        return {
+            "success": False,
+            "content": None,
+            "error": f"offset and limit must be non-negative (got offset={offset}, limit={limit})"
+        }
     try:
-        path = Path(file_path)
-        if not path.exists():
+        # One stat call covers both the existence and the file-type check
+        try:
+            st = os.stat(file_path)
+        except (FileNotFoundError, NotADirectoryError):
             return {
                 "success": False,
                 "content": None,
                 "error": f"File not found: {file_path}"
             }
-        if not path.is_file():
+        if not stat.S_ISREG(st.st_mode):
             return {
                 "success": False,
                 "content": None,
                 "error": f"Path is not a file: {file_path}"
             }
-        with open(path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        if offset == 0 and limit is None:
+            # One read() of the whole file and one C-level decode, no TextIOWrapper
+            data = Path(file_path).read_bytes()
+            truncated = False
+        else:
+            # Only the requested lines are kept in memory
+            with open(file_path, 'rb') as f:
+                stop = None if limit is None else offset + limit
+                data = b''.join(islice(f, offset, stop))
+                truncated = stop is not None and f.readline() != b''
         return {
             "success": True,
-            "content": content,
+            "content": data.decode('utf-8', 'replace'),
+            "truncated": truncated,
             "error": None
         }
     except Exception as e:
@@ -43,37 +85,85 @@ def cat_file(file_path: str) -> Dict[str, Any]:
         }
 
 
-def ls_directory(dir_path: str = ".") -> Dict[str, Any]:
+def cat_file_mmap(file_path: str) -> Optional[mmap.mmap]:
+    """Map a file read-only, for streaming its bytes without reading them into Python.
+    
+    Returns None when file_path is not a non-empty regular file that can be
+    mapped (empty files cannot be); callers fall back to cat_file.
+    """
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            return None
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    finally:
+        # The mapping stays valid after its descriptor is closed
+        os.close(fd)
+
+
+def iter_mmap(mm: mmap.mmap, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Yield the mapped bytes in chunk_size pieces, closing the mapping when done."""
+    try:
+        for start in range(0, len(mm), chunk_size):
+            yield mm[start:start + chunk_size]
+    finally:
+        mm.close()
+
+
+@lru_cache(maxsize=256)
+def _ls_cached(abs_path: str, mtime_ns: int, sort: bool = True) -> Tuple[Tuple[str, str], ...]:
+    """(name, type) entries of a directory, type being 'directory' or 'file'.
+    
+    Sorted by name when sort is set, otherwise in directory order.
+    
+    Keyed on the directory's mtime, which changes whenever an entry is
+    added, removed or renamed, so stale listings are never served.
+    """
+    with os.scandir(abs_path) as entries:
+        items = [(entry.name, "directory" if entry.is_dir() else "file") for entry in entries]
+    if sort:
+        items.sort()
+    return tuple(items)
+
+
+def ls_directory(dir_path: str = ".", sort: bool = True) -> Dict[str, Any]:
     """List files and directories in a given path.
     
     Args:
         dir_path: Path to the directory to list (default: current directory)
+        sort: Sort entries by name; pass False when order does not matter
         
     Returns:
-        Dict with 'success', 'items', and 'error' fields
+        Dict with 'success', 'items', and 'error' fields. Each item is a
+        (name, type, path) tuple, type being 'directory' or 'file'.
     """
     try:
-        path = Path(dir_path)
-        if not path.exists():
+        try:
+            st = os.stat(dir_path)
+        except (FileNotFoundError, NotADirectoryError):
             return {
                 "success": False,
                 "items": None,
                 "error": f"Directory not found: {dir_path}"
             }
-        if not path.is_dir():
+        if not stat.S_ISDIR(st.st_mode):
             return {
                 "success": False,
                 "items": None,
                 "error": f"Path is not a directory: {dir_path}"
             }
-        items = []
-        for item in sorted(path.iterdir()):
-            item_type = "directory" if item.is_dir() else "file"
-            items.append({
-                "name": item.name,
-                "type": item_type,
-                "path": str(item)
-            })
+        path = Path(dir_path)
+        listing = _ls_cached(str(path.resolve()), st.st_mtime_ns, sort)
+        # Same paths as str(path / name), without building a Path per entry
+        base = str(path)
+        prefix = "" if base == "." else os.path.join(base, "")
+        items = [(name, entry_type, prefix + name) for name, entry_type in listing]
         return {
             "success": True,
             "items": items,
@@ -87,67 +177,130 @@ def ls_directory(dir_path: str = ".") -> Dict[str, Any]:
         }
 
 
-def find_files(pattern: str, start_path: str = ".") -> Dict[str, Any]:
-    """Find files matching a pattern using Unix find command.
+# Directories find_files does not descend into by default: VCS metadata,
+# vendored dependencies, caches and build output
+FIND_PRUNED_DIRS = frozenset({
+    ".git", "node_modules", "__pycache__", ".venv",
+    "dist", "build", ".mypy_cache", ".pytest_cache"
+})
+
+# Paths returned by find_files when the caller does not set a limit
+FIND_DEFAULT_LIMIT = 500
+
+
+def _walk(
+    dir_path: str,
+    match: Callable[[str], Any],
+    out: List[str],
+    prune: frozenset,
+    cap: Optional[int]
+) -> bool:
+    """Append paths under dir_path whose name satisfies match, like `find -name`.
+    
+    Directories named in prune are still matched themselves, but not descended into.
+    Stops and returns True as soon as out holds cap paths.
+    """
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if match(entry.name):
+                    out.append(entry.path)
+                    if cap is not None and len(out) >= cap:
+                        return True
+                # Like find, do not follow symlinked directories
+                if entry.name not in prune and entry.is_dir(follow_symlinks=False):
+                    if _walk(entry.path, match, out, prune, cap):
+                        return True
+    except OSError:
+        # Skip unreadable directories, as find does (after a warning)
+        pass
+    return False
+
+
+def find_files(
+    pattern: str,
+    start_path: str = ".",
+    prune: Optional[List[str]] = None,
+    limit: Optional[int] = FIND_DEFAULT_LIMIT
+) -> Dict[str, Any]:
+    """Find files matching a pattern, with the semantics of `find <start_path> -name <pattern>`.
     
     Args:
         pattern: Filename pattern to search for (e.g., "*.py", "test*")
         start_path: Starting directory for the search (default: current directory)
+        prune: Directory names not to descend into (default: FIND_PRUNED_DIRS);
+            pass an empty list to search everything
+        limit: Maximum number of paths to return; None returns all of them
         
     Returns:
-        Dict with 'success', 'files', and 'error' fields
+        Dict with 'success', 'files', 'truncated', and 'error' fields.
+        'truncated' is true when more paths match than were returned.
     """
+    if limit is not None and limit < 0:
+        return {
+            "success": False,
+            "files": None,
+            "error": f"limit must be non-negative (got limit={limit})"
+        }
     try:
-        path = Path(start_path)
-        if not path.exists():
+        try:
+            st = os.stat(start_path)
+        except (FileNotFoundError, NotADirectoryError):
             return {
                 "success": False,
                 "files": None,
                 "error": f"Start path not found: {start_path}"
             }
         
-        # Use find command
-        result = subprocess.run(
-            ["find", str(path), "-name", pattern],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        
-        if result.returncode != 0:
-            return {
-                "success": False,
-                "files": None,
-                "error": f"Find command failed: {result.stderr}"
-            }
-        
-        files = [f.strip() for f in result.stdout.strip().split('\n') if f.strip()]
+        path = Path(start_path)
+        root = str(path)
+        files: List[str] = []
+        # Translate the glob once; the walk calls the compiled matcher per entry
+        match = re.compile(fnmatch.translate(pattern)).match
+        # One path past the limit tells whether the result is truncated
+        cap = None if limit is None else limit + 1
+        # find also tests the start path itself
+        if match(path.name or root):
+            files.append(root)
+        if stat.S_ISDIR(st.st_mode) and (cap is None or len(files) < cap):
+            _walk(root, match, files, FIND_PRUNED_DIRS if prune is None else frozenset(prune), cap)
+        truncated = limit is not None and len(files) > limit
         return {
             "success": True,
-            "files": files,
+            "files": files[:limit] if truncated else files,
+            "truncated": truncated,
             "error": None
         }
-    except subprocess.TimeoutExpired:
-        return {
-            "success": False,
-            "files": None,
-            "error": "Find command timed out"
-        }
     except Exception as e:
         return {
             "success": False,
             "files": None,
-            "error": f"Error running find: {str(e)}"
+            "error": f"Error finding files: {str(e)}"
         }
 
 
-# Global searcher instance (will be set by main.py)
-_searcher = None
+class _IndexNotLoaded(RuntimeError):
+    """Raised by the search tool before set_searcher has been called."""
+
+
+def _search_not_loaded(question: str, index_type: str, top_k: int):
+    raise _IndexNotLoaded("Index not loaded. Please run /index endpoint first.")
+
+
+def _no_indexed_content(file_path: str) -> str:
+    # Empty content makes list_file_content fall back to the file system
+    return ""
+
+
+# Bound methods of the global searcher (set by main.py), called directly by the tools
+_search_fn = _search_not_loaded
+_list_fn = _no_indexed_content
 
 def set_searcher(searcher):
     """Set the global searcher instance."""
-    global _searcher
-    _searcher = searcher
+    global _search_fn, _list_fn
+    _search_fn = searcher.search
+    _list_fn = searcher.list_file_content
 
 def search_codebase(question: str, index_type: str, top_k: int = 5) -> Dict[str, Any]:
     """Search the indexed codebase.
@@ -160,21 +313,29 @@ def search_codebase(question: str, index_type: str, top_k: int = 5) -> Dict[str,
     Returns:
         Dict with 'success', 'results', and 'error' fields
     """
-    global _searcher
-    if _searcher is None:
+    # Blank questions are rejected before any embedding call; stripping lets
+    # retries that differ only in whitespace hit the searcher's result cache
+    question = question.strip()
+    if not question:
         return {
             "success": False,
             "results": None,
-            "error": "Index not loaded. Please run /index endpoint first."
+            "error": "Search question is empty."
         }
     
     try:
-        results = _searcher.search(question, index_type, top_k)
+        results = _search_fn(question, index_type, top_k)
         return {
             "success": True,
-            "results": results,
+            "results": [hit.to_dict() for hit in results],
             "error": None
         }
+    except _IndexNotLoaded as e:
+        return {
+            "success": False,
+            "results": None,
+            "error": str(e)
+        }
     except Exception as e:
         return {
             "success": False,
@@ -191,13 +352,8 @@ def list_file_content(file_path: str) -> Dict[str, Any]:
     Returns:
         Dict with 'success', 'content', and 'error' fields
     """
-    global _searcher
-    if _searcher is None:
-        # Fallback to file system
-        return cat_file(file_path)
-    
     try:
-        content = _searcher.list_file_content(file_path)
+        content = _list_fn(file_path)
         if content:
             return {
                 "success": True,
@@ -205,8 +361,8 @@ def list_file_content(file_path: str) -> Dict[str, Any]:
                 "error": None
             }
         else:
-            # Fallback to file system
-            return cat_file(file_path)
+            # Fallback to file system; this tool promises the full content, not cat's default line range
+            return cat_file(file_path, limit=None)
     except Exception as e:
         return {
             "success": False,
@@ -256,13 +412,25 @@ TOOLS = {
     },
     "cat": {
         "function": cat_file,
-        "description": "Read the contents of a file from filesystem. Use this when you need to see what's inside a file.",
+        "description": "Read the contents of a file from filesystem. Use this when you need to see what's inside a file. Long files are returned in ranges of lines; 'truncated' tells whether more lines follow.",
         "parameters": {
             "type": "object",
             "properties": {
                 "file_path": {
                     "type": "string",
                     "description": "Path to the file to read"
+                },
+                "offset": {
+                    "type": "integer",
+                    "description": "Number of lines to skip from the start of the file (default: 0)",
+                    "minimum": 0,
+                    "default": 0
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": f"Maximum number of lines to return (default: {CAT_DEFAULT_LIMIT})",
+                    "minimum": 0,
+                    "default": CAT_DEFAULT_LIMIT
                 }
             },
             "required": ["file_path"]
@@ -270,7 +438,7 @@ TOOLS = {
     },
     "ls": {
         "function": ls_directory,
-        "description": "List files and directories in a given path. Use this to explore the directory structure.",
+        "description": "List files and directories in a given path. Use this to explore the directory structure. Each item is [name, type, path], type being 'directory' or 'file'.",
         "parameters": {
             "type": "object",
             "properties": {
@@ -278,6 +446,11 @@ TOOLS = {
                     "type": "string",
                     "description": "Path to the directory to list (default: current directory)",
                     "default": "."
+                },
+                "sort": {
+                    "type": "boolean",
+                    "description": "Sort entries by name (default: true); set to false when order does not matter",
+                    "default": True
                 }
             },
             "required": []
@@ -297,6 +470,17 @@ TOOLS = {
                     "type": "string",
                     "description": "Starting directory for search (default: current directory)",
                     "default": "."
+                },
+                "prune": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": f"Directory names not to descend into (default: {sorted(FIND_PRUNED_DIRS)}); pass [] to search everything"
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": f"Maximum number of paths to return (default: {FIND_DEFAULT_LIMIT}); 'truncated' tells whether more matched",
+                    "minimum": 0,
+                    "default": FIND_DEFAULT_LIMIT
                 }
             },
             "required": ["pattern"]
@@ -304,3 +488,16 @@ TOOLS = {
     }
 }
 
+# Tool definitions in the OpenAI function-calling format. The schemas never
+# change, so the list is built once here rather than on every agent question
+OPENAI_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": tool_name,
+            "description": tool_info["description"],
+            "parameters": tool_info["parameters"]
+        }
+    }
+    for tool_name, tool_info in TOOLS.items()
+]
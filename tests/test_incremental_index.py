@@ -0,0 +1,130 @@
+"""Tests for incremental re-indexing: reusing chunks and vectors of unchanged files.
+
+Embeddings are faked with deterministic per-text vectors, so no API key is
+needed. Run with `python -m pytest tests/test_incremental_index.py`.
+"""
+import hashlib
+import sys
+from pathlib import Path
+
+import faiss
+import numpy as np
+import orjson
+import pytest
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.indexing import CodeIndexer, EMBEDDING_DIMENSIONS, MANIFEST_FILE, _content_hash
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+DIMENSION = EMBEDDING_DIMENSIONS[EMBEDDING_MODEL]
+
+SHARED_FUNCTION = '''\
+def shared(value):
+    return value * 2 + 1
+'''
+
+
+def fake_vector(text: str) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'big')
+    return np.random.default_rng(seed).standard_normal(DIMENSION).astype(np.float32)
+
+
+def unique_function(name: str) -> str:
+    """A function whose text shares no shingles with the others (no near-duplicate grouping)."""
+    words = ' '.join(f"{name}_{i}" for i in range(40))
+    return f'def {name}():\n    return "{words}"\n'
+
+
+@pytest.fixture
+def embedded(monkeypatch):
+    """Replace the embedding API; maps content hash -> vector of every text sent, per run."""
+    runs = []
+
+    async def fake_get_embeddings(self, client, texts):
+        runs[-1].update({_content_hash(t.encode('utf-8')): fake_vector(t) for t in texts})
+        return np.stack([fake_vector(t) for t in texts])
+
+    monkeypatch.setattr(CodeIndexer, "_get_embeddings_async", fake_get_embeddings)
+    return runs
+
+
+def run_index(repo: Path, output: Path, runs: list) -> dict:
+    runs.append({})
+    indexer = CodeIndexer(embedding_model=EMBEDDING_MODEL, api_key="test-key", vector_quantization="none")
+    indexer.index(str(repo), str(output), max_workers=2)
+    metadata = orjson.loads((output / "metadata.json").read_bytes())
+    manifest = orjson.loads((output / MANIFEST_FILE).read_bytes())
+    return {"chunks": metadata["chunks"], "manifest": manifest}
+
+
+def assert_vectors_match_chunks(output: Path, chunks: list, runs: list):
+    """Every chunk's vector id must hold the (normalized) embedding of that chunk's text."""
+    vectors_by_hash = {h: v for run in runs for h, v in run.items()}
+    for chunk_type in ("file", "function"):
+        typed = [c for c in chunks if c["type"] == chunk_type]
+        index = faiss.read_index(str(output / f"{chunk_type}_index.faiss"))
+        assert index.ntotal == len(typed)
+        stored = index.reconstruct_n(0, index.ntotal)
+        for position, chunk in enumerate(typed):
+            expected = vectors_by_hash[chunk["content_hash"]]
+            expected = expected / np.linalg.norm(expected)
+            np.testing.assert_allclose(stored[position], expected, atol=1e-5)
+
+
+def test_incremental_reindex(tmp_path, embedded):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    output = tmp_path / "index"
+    (repo / "a.py").write_text(unique_function("alpha") + "\n\n" + SHARED_FUNCTION)
+    (repo / "b.py").write_text(unique_function("beta") + "\n\n" + SHARED_FUNCTION)
+    (repo / "c.py").write_text(unique_function("gamma"))
+
+    first = run_index(repo, output, embedded)
+    assert_vectors_match_chunks(output, first["chunks"], embedded)
+
+    # The two copies of shared() collapse onto one representative
+    function_chunks = [c for c in first["chunks"] if c["type"] == "function"]
+    shared_chunks = [c for c in function_chunks if c["function_name"] == "shared"]
+    assert len(shared_chunks) == 2
+    duplicate = next(c for c in shared_chunks if "dup_of" in c)
+    representative = function_chunks[duplicate["dup_of"]]
+    assert representative["function_name"] == "shared"
+    assert representative["file_path"] != duplicate["file_path"]
+    kept_path = duplicate["file_path"]
+
+    # Delete the representative's file, modify c.py, leave the duplicate's file alone
+    Path(representative["file_path"]).unlink()
+    (repo / "c.py").write_text(unique_function("gamma") + "\n\n" + unique_function("delta"))
+
+    second = run_index(repo, output, embedded)
+    chunks = second["chunks"]
+    assert_vectors_match_chunks(output, chunks, embedded)
+
+    # Deleted file drops out of the metadata and the manifest
+    assert representative["file_path"] not in {c["file_path"] for c in chunks}
+    assert representative["file_path"] not in second["manifest"]["files"]
+
+    # Unchanged file reuses its rows without being embedded again
+    kept_before = [c for c in first["chunks"] if c["file_path"] == kept_path]
+    kept_after = [c for c in chunks if c["file_path"] == kept_path]
+    assert [c["content_hash"] for c in kept_after] == [c["content_hash"] for c in kept_before]
+    assert not {c["content_hash"] for c in kept_after} & set(embedded[-1])
+
+    # Its dup_of pointed at the dropped representative, so it is reset
+    assert all("dup_of" not in c for c in kept_after)
+
+    # Modified file is re-embedded, with its new function
+    c_path = str(repo / "c.py")
+    c_chunks = [c for c in chunks if c["file_path"] == c_path]
+    assert sorted(c["function_name"] for c in c_chunks if c["type"] == "function") == ["delta", "gamma"]
+    assert {c["content_hash"] for c in c_chunks} <= set(embedded[-1])
+
+    # Manifest chunk ids point at the rows of each file
+    for file_path, entry in second["manifest"]["files"].items():
+        assert {chunks[row]["file_path"] for row in entry["chunks"]} == {file_path}
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-v"]))
@@ -1,145 +1,172 @@
-"""Simple test script to verify the MVP works."""
+"""MVP smoke tests: tools, models, embeddings and an agent query.
+
+Run with `python -m pytest tests/test_mvp.py` (or `python tests/test_mvp.py`).
+Tests that call the OpenAI API are skipped when OPENAI_API_KEY is not set.
+"""
 import os
 import sys
 from pathlib import Path
 
+import orjson
+import pytest
+
 # Add parent directory to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent))
-
-# Test if we can import (will fail if dependencies not installed)
-try:
-    from src.agent import Agent
-    from src.models import FinalAnswer
-    from src.tools import cat_file, ls_directory, find_files
-    print("✓ All imports successful")
-except ImportError as e:
-    print(f"✗ Import failed: {e}")
-    print("Please install dependencies first:")
-    print("  uv pip install -r requirements.txt")
-    sys.exit(1)
-
-# Test tools
-print("\n--- Testing Tools ---")
-print("\n1. Testing ls_directory:")
-result = ls_directory(".")
-if result["success"]:
-    print(f"   ✓ Found {len(result['items'])} items")
-    for item in result["items"][:5]:
-        print(f"      - {item['name']} ({item['type']})")
-else:
-    print(f"   ✗ Error: {result['error']}")
-
-print("\n2. Testing cat_file (reading this file):")
-result = cat_file(__file__)
-if result["success"]:
-    print(f"   ✓ File read successfully ({len(result['content'])} chars)")
-else:
-    print(f"   ✗ Error: {result['error']}")
-
-print("\n3. Testing find_files:")
-result = find_files("*.py", ".")
-if result["success"]:
-    print(f"   ✓ Found {len(result['files'])} Python files")
-    for f in result["files"][:3]:
-        print(f"      - {f}")
-else:
-    print(f"   ✗ Error: {result['error']}")
-
-# Test Agent initialization
-print("\n--- Testing Agent Initialization ---")
-try:
-    agent = Agent(model="gpt-5-mini", max_iterations=3)
-    print("✓ Agent initialized successfully")
-    print(f"   Model: {agent.model}")
-    print(f"   Max iterations: {agent.max_iterations}")
-except Exception as e:
-    print(f"✗ Agent initialization failed: {e}")
-    sys.exit(1)
-
-# Test Pydantic model
-print("\n--- Testing Pydantic Model ---")
-try:
+PROJECT_ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from src.agent import Agent
+from src.models import FinalAnswer
+from src.tools import cat_file, ls_directory, find_files
+
+requires_api_key = pytest.mark.skipif(
+    not os.getenv("OPENAI_API_KEY"),
+    reason="OPENAI_API_KEY not set"
+)
+
+
+@pytest.fixture(scope="module")
+def agent():
+    """One agent shared by every test in this module."""
+    return Agent(model="gpt-5-mini", max_iterations=3)
+
+
+@pytest.fixture(scope="module")
+def openai_client():
+    """One OpenAI client shared by every test in this module."""
+    from openai import OpenAI
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+@pytest.mark.parametrize("tool, args, field", [
+    (ls_directory, (str(PROJECT_ROOT),), "items"),
+    (cat_file, (__file__,), "content"),
+    (find_files, ("*.py", str(PROJECT_ROOT)), "files"),
+], ids=["ls", "cat", "find"])
+def test_tool(tool, args, field):
+    result = tool(*args)
+    assert result["success"], result["error"]
+    assert result[field]
+
+
+@pytest.fixture
+def numbered_file(tmp_path):
+    """A file with the five lines 'line 0' .. 'line 4'."""
+    path = tmp_path / "numbered.txt"
+    path.write_text("".join(f"line {i}\n" for i in range(5)))
+    return str(path)
+
+
+@pytest.mark.parametrize("offset, limit, content, truncated", [
+    (0, 2, "line 0\nline 1\n", True),
+    (1, 2, "line 1\nline 2\n", True),
+    (3, 2, "line 3\nline 4\n", False),
+    (0, 5, "".join(f"line {i}\n" for i in range(5)), False),
+    (2, None, "line 2\nline 3\nline 4\n", False),
+    (0, None, "".join(f"line {i}\n" for i in range(5)), False),
+    (10, 2, "", False),
+    (0, 0, "", True),
+])
+def test_cat_file_line_range(numbered_file, offset, limit, content, truncated):
+    result = cat_file(numbered_file, offset=offset, limit=limit)
+    assert result["success"], result["error"]
+    assert result["content"] == content
+    assert result["truncated"] is truncated
+
+
+@pytest.mark.parametrize("offset, limit", [(-1, 10), (0, -1)])
+def test_cat_file_rejects_negative_range(numbered_file, offset, limit):
+    result = cat_file(numbered_file, offset=offset, limit=limit)
+    assert not result["success"]
+    assert "non-negative" in result["error"]
+
+
+@pytest.fixture
+def source_tree(tmp_path):
+    """Three .py files in the tree proper, plus one inside node_modules."""
+    (tmp_path / "a.py").write_text("")
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "b.py").write_text("")
+    (tmp_path / "pkg" / "c.py").write_text("")
+    (tmp_path / "node_modules").mkdir()
+    (tmp_path / "node_modules" / "vendored.py").write_text("")
+    return tmp_path
+
+
+@pytest.mark.parametrize("limit, count, truncated", [
+    (2, 2, True),
+    (3, 3, False),
+    (4, 3, False),
+    (None, 3, False),
+])
+def test_find_files_limit(source_tree, limit, count, truncated):
+    result = find_files("*.py", str(source_tree), limit=limit)
+    assert result["success"], result["error"]
+    assert len(result["files"]) == count
+    assert result["truncated"] is truncated
+
+
+def test_find_files_prunes_by_default(source_tree):
+    result = find_files("*.py", str(source_tree))
+    assert str(source_tree / "node_modules" / "vendored.py") not in result["files"]
+
+    result = find_files("*.py", str(source_tree), prune=[])
+    assert str(source_tree / "node_modules" / "vendored.py") in result["files"]
+    assert len(result["files"]) == 4
+
+
+def test_find_files_pruned_directory_still_matches_itself(source_tree):
+    result = find_files("node_modules", str(source_tree))
+    assert result["files"] == [str(source_tree / "node_modules")]
+
+
+def test_find_files_rejects_negative_limit(source_tree):
+    result = find_files("*.py", str(source_tree), limit=-1)
+    assert not result["success"]
+    assert "non-negative" in result["error"]
+
+
+def test_final_answer_serialization():
     answer = FinalAnswer(
         answer="This is a test answer",
         confidence="high",
         sources=["test.py"],
         reasoning="Testing the model"
     )
-    print("✓ FinalAnswer model created successfully")
-    print(f"   Answer: {answer.answer[:50]}...")
-    print(f"   Confidence: {answer.confidence}")
-    print(f"   Sources: {answer.sources}")
-    
-    # Test JSON serialization
-    json_str = answer.model_dump_json()
-    print(f"   JSON serialization: ✓ ({len(json_str)} chars)")
-except Exception as e:
-    print(f"✗ Pydantic model test failed: {e}")
-    sys.exit(1)
-
-# Test OpenAI Embedding API
-print("\n--- Testing OpenAI Embedding API ---")
-if not os.getenv("OPENAI_API_KEY"):
-    print("⚠ OPENAI_API_KEY not set, skipping embedding test")
-else:
-    try:
-        from openai import OpenAI
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
-        test_texts = [
-            "This is a test string for embedding",
-            "这是中文测试文本",
-            "def hello_world():\n    print('Hello, World!')"
-        ]
-        
-        print(f"   Testing with {len(test_texts)} text samples...")
-        print(f"   Model: text-embedding-3-small")
-        
-        response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=test_texts
-        )
-        
-        print(f"   ✓ Embedding API call successful")
-        print(f"   ✓ Generated {len(response.data)} embeddings")
-        
-        for i, embedding_data in enumerate(response.data):
-            dim = len(embedding_data.embedding)
-            print(f"      Embedding {i+1}: dimension={dim}, text='{test_texts[i][:30]}...'")
-        
-        # Test single embedding
-        single_response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input="Single text embedding test"
-        )
-        print(f"   ✓ Single embedding test successful (dim={len(single_response.data[0].embedding)})")
-        
-    except Exception as e:
-        print(f"✗ Embedding API test failed: {e}")
-        import traceback
-        traceback.print_exc()
-        sys.exit(1)
-
-# Test actual Agent query with tools
-print("\n--- Testing Agent Query with Tools ---")
-if not os.getenv("OPENAI_API_KEY"):
-    print("⚠ OPENAI_API_KEY not set, skipping Agent query test")
-    print("\n--- All basic tests passed! ---")
-    sys.exit(0)
-
-try:
-    print("Testing: '列出当前目录下的所有 Python 文件'")
+    json_bytes = orjson.dumps(answer.model_dump())
+    assert FinalAnswer(**orjson.loads(json_bytes)) == answer
+
+
+@requires_api_key
+def test_agent_init(agent):
+    assert agent.model == "gpt-5-mini"
+    assert agent.max_iterations == 3
+
+
+@requires_api_key
+def test_embeddings(openai_client):
+    test_texts = [
+        "This is a test string for embedding",
+        "这是中文测试文本",
+        "def hello_world():\n    print('Hello, World!')"
+    ]
+    single_text = "Single text embedding test"
+
+    # One request for both checks: the batch and the single text share a model
+    response = openai_client.embeddings.create(
+        model="text-embedding-3-small",
+        input=[*test_texts, single_text]
+    )
+    assert len(response.data) == len(test_texts) + 1
+    dims = {len(item.embedding) for item in response.data}
+    assert dims == {1536}
+
+
+@requires_api_key
+def test_agent_query(agent):
     result = agent.query("列出当前目录下的所有 Python 文件")
-    print("✓ Agent query completed successfully")
-    print(f"\n   Answer: {result.answer[:200]}...")
-    print(f"   Confidence: {result.confidence}")
-    print(f"   Sources: {result.sources}")
-    if result.reasoning:
-        print(f"   Reasoning: {result.reasoning}")
-except Exception as e:
-    print(f"✗ Agent query failed: {e}")
-    import traceback
-    traceback.print_exc()
-    sys.exit(1)
-
-print("\n--- All tests passed! ---")
+    assert result.answer
+    assert result.confidence in ("high", "medium", "low")
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-v"]))
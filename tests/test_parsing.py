@@ -0,0 +1,90 @@
+"""Tests for the fast function-extraction path used before tree-sitter and the LLM.
+
+Run with `python -m pytest tests/test_parsing.py`.
+"""
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.indexing import _parse_functions_fast
+
+
+def spans(file_path, content):
+    return [
+        (f["function_name"], f["start_line"], f["end_line"])
+        for f in _parse_functions_fast(file_path, content)
+    ]
+
+
+def test_python_column0_string_body_does_not_end_function():
+    content = textwrap.dedent('''\
+        def prompt():
+            text = """first line
+        column-0 line inside the string
+        another one
+        """
+            return text
+
+
+        def after():
+            pass
+        ''')
+    assert spans("a.py", content) == [("prompt", 1, 6), ("after", 9, 10)]
+
+
+def test_python_method_with_column0_string_body():
+    content = textwrap.dedent('''\
+        class Agent:
+            def system_prompt(self):
+                base = """你是一个代码库专家。
+        1. search(question: str)
+        2. cat(file_path: str)"""
+                return base
+
+            def other(self):
+                return 1
+        ''')
+    assert spans("a.py", content) == [("system_prompt", 2, 6), ("other", 8, 9)]
+
+
+def test_python_parentheses_in_strings_and_comments_of_signature():
+    content = textwrap.dedent('''\
+        def f(a=")",  # closing ) in a comment
+              b="(("):
+            return a + b
+        x = 1
+        ''')
+    assert spans("a.py", content) == [("f", 1, 3)]
+
+
+def test_python_async_decorated_and_nested():
+    content = textwrap.dedent('''\
+        @decorator
+        async def outer():
+            def inner():
+                return 1
+            return inner()
+        ''')
+    assert spans("a.py", content) == [("outer", 2, 5), ("inner", 3, 4)]
+
+
+def test_python_unparsable_source_has_no_fast_path():
+    assert _parse_functions_fast("a.py", "def broken(:\n    pass\n") is None
+
+
+def test_go_regex_fast_path():
+    content = "package main\n\nfunc (s *Server) Run() {\n\treturn\n}\n\nfunc main() {}\n"
+    assert spans("a.go", content) == [("Run", 3, 5), ("main", 7, 7)]
+
+
+def test_unsupported_language_has_no_fast_path():
+    assert _parse_functions_fast("a.rb", "def f\nend\n") is None
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-v"]))